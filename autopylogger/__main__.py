@@ -0,0 +1,98 @@
+"""
+Command line tools of autopylogger.
+
+Print the records of the last hour containing 'timeout', from all levels:
+
+    python -m autopylogger query --log-directory logs --log-name my_logs --since 1h --grep timeout
+
+Print the ERROR records of a time range:
+
+    python -m autopylogger query --log-name my_logs --since '2020-01-31 10:00' --until '2020-01-31 11:00' --level ERROR
+"""
+import re
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+
+from autopylogger.reader import query
+from autopylogger.autopylogger import ROTATION_NAMINGS
+
+# Times relative to now, e.g. '30s', '15m', '2h', '1d' (or '-2h') ago
+_RELATIVE_TIME = re.compile(r'^-?(\d+(?:\.\d+)?)([smhd])$')
+
+_UNIT_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_time(value):
+    """
+
+    Function to convert a command line time to seconds since the epoch
+
+    :param value: Seconds since the epoch, a time ago like '2h', or a local date and time like
+        '2020-01-31 10:00:00'
+    :type value: str
+    :return: Seconds since the epoch
+    :rtype: float
+
+    """
+    match = _RELATIVE_TIME.match(value)
+    if match:
+        return time.time() - float(match.group(1)) * _UNIT_SECONDS[match.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid time %r. Use seconds since the epoch, a time ago like 2h, '
+                                         'or a date and time like "2020-01-31 10:00:00".' % value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m autopylogger', description='Tools for autopylogger log files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    query_parser = commands.add_parser('query', help='Print the records of a time range, in time order')
+    query_parser.add_argument('--log-directory', default='logs', help='Directory of the logs (default: logs)')
+    query_parser.add_argument('--log-name', default='logger', help='Name of the log (default: logger)')
+    query_parser.add_argument('--since', type=parse_time, help='Earliest record time')
+    query_parser.add_argument('--until', type=parse_time, help='Latest record time')
+    query_parser.add_argument('--level', type=lambda value: value.split(','), default=None,
+                              help='Comma separated levels (DEBUG,INFO,WARNING,ERROR), all by default')
+    query_parser.add_argument('--grep', help='Regular expression the records must contain')
+    query_parser.add_argument('--encoding', default='utf-8', help='Encoding of text log files (default: utf-8)')
+    query_parser.add_argument('--utc', action='store_true', help='Text log files were written with utc=True')
+    query_parser.add_argument('--date-format', help='date_format the text log files were written with, '
+                                                    'e.g. "%%Y-%%m-%%dT%%H:%%M:%%S"')
+    query_parser.add_argument('--rotation-naming', choices=ROTATION_NAMINGS,
+                              help='rotation_naming the log files were written with, the default naming if not given')
+    args = parser.parse_args(argv)
+
+    level_names = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+    if args.level and not all(level.upper() in level_names for level in args.level):
+        query_parser.error('Invalid level. Options: %s' % ', '.join(level_names))
+
+    try:
+        entries = query(args.log_directory, args.log_name, since=args.since, until=args.until, levels=args.level,
+                        grep=args.grep, encoding=args.encoding, utc=args.utc, date_format=args.date_format,
+                        rotation_naming=args.rotation_naming)
+    except ValueError as e:
+        query_parser.error(str(e))
+
+    try:
+        for entry in entries:
+            if isinstance(entry.record, str):
+                print(entry.record)
+            else:
+                print(json.dumps(entry.record, ensure_ascii=False, default=str))
+    except BrokenPipeError:
+        # Output piped to e.g. head, which stopped reading
+        sys.stderr.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
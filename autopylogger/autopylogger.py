@@ -1,14 +1,1029 @@
 import os
+import io
+import re
+import json
+import sys
+import atexit
+import bisect
+import asyncio
+import codecs
+import collections.abc
+import gzip
+import locale
 import logging
+import email.utils
+import pickle
+import queue
+import random
+import selectors
+import shutil
+import socket
+import struct
 import traceback
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, SMTPHandler
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, SMTPHandler, QueueHandler
 import time
 import smtplib
+import stat
+import threading
 import warnings
+import weakref
+import itertools
+from collections import deque, OrderedDict
+from operator import itemgetter
+from email.message import EmailMessage
 warnings.simplefilter('always', DeprecationWarning)
 
+# Policies for a full queue in async mode
+QUEUE_POLICIES = ('block', 'drop_oldest', 'drop_newest')
 
-class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+# Seconds the async writer thread keeps the GIL before yielding it. A thread waiting for the GIL otherwise
+# gets it only after the switch interval (5 ms), which stalls an event loop logging to the writer.
+_WRITER_YIELD_INTERVAL = 0.0005
+
+# Naming schemes of rotated files which need no shifting of older backups
+ROTATION_NAMINGS = ('timestamp', 'sequence')
+
+# Compression formats for rotated files, with their file extension
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Suffix of files rotated with the 'timestamp' naming, e.g. '20200131-235959-000123'
+_TIMESTAMP_SUFFIX = re.compile(r'^\d{8}-\d{6}-\d{6}$')
+
+# Length prefix of each record sent to the collector in multi-process mode
+_FRAME_HEADER = struct.Struct('>I')
+
+# Renders tracebacks of records serialized by worker processes
+_exception_formatter = logging.Formatter()
+
+# Roles of a process in multi-process mode
+PROCESS_MODES = ('collector', 'worker')
+
+# Fields of a %-style format string, e.g. '%(asctime)s'
+_FORMAT_FIELD = re.compile(r'%\((\w+)\)')
+
+# A literal '%%' or the name of a field of a %-style format string
+_FORMAT_TOKEN = re.compile(r'%%|%\((\w+)\)')
+
+# Record fields which need the stack walk of findCaller
+CALLER_FIELDS = frozenset(('pathname', 'filename', 'module', 'lineno', 'funcName'))
+
+# Record fields about the current thread
+THREAD_FIELDS = frozenset(('thread', 'threadName'))
+
+# What findCaller returns when the caller is not looked up
+UNKNOWN_CALLER = ("(unknown file)", 0, "(unknown function)", None)
+
+# Level, directory and file extension of each level log file
+LEVEL_FILES = ((logging.DEBUG, 'Debug', '.debug'),
+               (logging.INFO, 'Info', '.info'),
+               (logging.WARNING, 'Warning', '.warn'),
+               (logging.ERROR, 'Error', '.error'))
+
+# Output formats of the level log files
+OUTPUT_FORMATS = ('text', 'jsonl', 'msgpack')
+
+# Keys of the rate limit buckets: the calling line, or the message template
+RATE_LIMIT_KEYS = ('callsite', 'template')
+
+# Upper bounds in seconds of the duration histograms of Metrics
+HISTOGRAM_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+# Entry of the sidecar index of a log file: creation time of a record and its offset in the file
+INDEX_ENTRY = struct.Struct('<dQ')
+
+# Directory of the sidecar index files, inside each level directory
+INDEX_DIRECTORY = '.index'
+
+# Attributes of every log record; any other public attribute was passed with 'extra'
+_RECORD_ATTRIBUTES = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'exc_frames',
+                                                                       'flight_records'}
+
+
+class BufferFlusher(object):
+    """
+    Background thread which writes out the buffers of idle buffered
+    handlers, so records never wait more than about 'flushInterval'
+    seconds on disk even when no further record arrives.
+    """
+
+    def __init__(self):
+        self._handlers = weakref.WeakSet()
+        self._mutex = threading.Lock()
+        self._wakeup = threading.Event()
+        self._interval = None
+        self._thread = None
+
+    def register(self, handler):
+        with self._mutex:
+            self._handlers.add(handler)
+            if self._interval is None or handler.flushInterval < self._interval:
+                self._interval = handler.flushInterval
+                self._wakeup.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='autopylogger-flusher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def after_fork(self):
+        """
+        Drop the records the parent buffered and start a new thread for the
+        handlers still registered. Called in a forked child, without the
+        thread of the parent.
+        """
+        self._mutex = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        handlers = list(self._handlers)
+        # Buffered records are a copy of those the parent writes, the child drops them
+        for handler in handlers:
+            handler.discard_buffer()
+        if handlers:
+            self._start()
+
+    def unregister(self, handler):
+        with self._mutex:
+            self._handlers.discard(handler)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+            with self._mutex:
+                handlers = list(self._handlers)
+            now = time.time()
+            for handler in handlers:
+                if handler.isDirty() and now - handler.lastFlush >= handler.flushInterval:
+                    handler.flush()
+
+
+# Shared by all buffered handlers
+_buffer_flusher = BufferFlusher()
+
+
+class RotationWorker(object):
+    """
+    Background thread which compresses rotated files and prunes old
+    backups, so that a rollover on the logging thread only has to close
+    the current file, rename it and open a new one.
+    """
+
+    def __init__(self):
+        self._jobs = queue.Queue()
+        self._mutex = threading.Lock()
+        self._thread = None
+        self._wait_at_exit = False
+
+    def submit(self, filename, base_filename, backup_count, naming, compression):
+        with self._mutex:
+            if self._thread is None or not self._thread.is_alive():
+                if not self._wait_at_exit:
+                    atexit.register(self.wait)
+                    self._wait_at_exit = True
+                self._thread = threading.Thread(target=self._run, name='autopylogger-rotation')
+                self._thread.daemon = True
+                self._thread.start()
+        self._jobs.put((filename, base_filename, backup_count, naming, compression))
+
+    def wait(self):
+        """
+        Wait until every submitted rotated file has been compressed and pruned.
+        """
+        self._jobs.join()
+
+    def after_fork(self):
+        """
+        Drop the jobs left by the parent, which runs them itself. Called in a
+        forked child; the thread is started again with the next job.
+        """
+        self._mutex = threading.Lock()
+        self._jobs = queue.Queue()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                self._process(*job)
+            except Exception:
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+            finally:
+                self._jobs.task_done()
+
+    def _process(self, filename, base_filename, backup_count, naming, compression):
+        if compression and os.path.exists(filename):
+            compress_file(filename, compression)
+        if backup_count > 0:
+            for backup in list_backups(base_filename, naming)[:-backup_count]:
+                os.remove(backup)
+                remove_index(backup)
+
+
+# Shared by all handlers using a rotation naming scheme
+_rotation_worker = RotationWorker()
+
+
+class FilePool(object):
+    """
+    Open level files of all handlers, least recently written first.
+
+    With a 'max_open' (see 'max_open_files' of init_logging), opening a
+    file beyond that many closes the file of the handler written to
+    longest ago, which reopens it in append mode with its next record. So
+    any number of loggers share a bounded number of file descriptors. A
+    handler busy writing on another thread is skipped rather than waited
+    for. A 'max_open' of 0 leaves every file open.
+    """
+
+    def __init__(self):
+        self.max_open = 0
+        self._handlers = OrderedDict()
+        self._mutex = threading.Lock()
+
+    def opened(self, handler):
+        with self._mutex:
+            self._handlers[handler] = None
+            self._handlers.move_to_end(handler)
+            if len(self._handlers) > self.max_open:
+                self._evict(handler)
+
+    def used(self, handler):
+        with self._mutex:
+            if handler in self._handlers:
+                self._handlers.move_to_end(handler)
+
+    def discard(self, handler):
+        with self._mutex:
+            self._handlers.pop(handler, None)
+
+    def _evict(self, current):
+        for handler in list(self._handlers):
+            if len(self._handlers) <= self.max_open:
+                break
+            if handler is current or not handler.lock.acquire(blocking=False):
+                continue
+            try:
+                handler.release_stream()
+            finally:
+                handler.lock.release()
+            del self._handlers[handler]
+
+
+# Shared by all tracked file handlers
+_file_pool = FilePool()
+
+
+def _discard_stream(stream):
+    # Whatever the stream still writes goes to the null device instead of its file
+    if stream is not None:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        try:
+            os.dup2(devnull, stream.fileno())
+        finally:
+            os.close(devnull)
+        stream.close()
+
+
+# Handlers running a thread of their own, which only the parent keeps after a fork, see _after_fork_in_child
+_threaded_handlers = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    # Threads do not survive a fork, and locks held by threads of the parent would never be released
+    _file_pool._mutex = threading.Lock()
+    _rotation_worker.after_fork()
+    _buffer_flusher.after_fork()
+    for handler in list(_threaded_handlers):
+        handler.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def compress_file(filename, compression):
+    """
+
+    Function to compress a file, replacing it with '<filename>.gz' or '<filename>.zst'
+
+    :param filename: Path of the file
+    :type filename: str
+    :param compression: Compression format. Options: 'gzip' | 'zstd'
+    :type compression: str
+    :return: Path of the compressed file
+    :rtype: str
+
+    """
+    compressed_filename = filename + COMPRESSIONS[compression]
+    # Written under a temporary name, so a partly compressed file is never taken for a backup
+    temp_filename = compressed_filename + '.tmp'
+    with open(filename, 'rb') as source:
+        if compression == 'zstd':
+            import zstandard
+            with open(temp_filename, 'wb') as target:
+                zstandard.ZstdCompressor().copy_stream(source, target)
+        else:
+            with gzip.open(temp_filename, 'wb') as target:
+                shutil.copyfileobj(source, target)
+    os.replace(temp_filename, compressed_filename)
+    os.remove(filename)
+    return compressed_filename
+
+
+def index_filename(filename):
+    """
+
+    Function to get the path of the sidecar index of a log file, which is kept when the file is compressed
+
+    :param filename: Path of the log file
+    :type filename: str
+    :return: Path of the index file
+    :rtype: str
+
+    """
+    directory, file_name = os.path.split(filename)
+    for extension in COMPRESSIONS.values():
+        if file_name.endswith(extension):
+            file_name = file_name[:-len(extension)]
+            break
+    return os.path.join(directory, INDEX_DIRECTORY, file_name + '.idx')
+
+
+def remove_index(filename):
+    try:
+        os.remove(index_filename(filename))
+    except FileNotFoundError:
+        pass
+
+
+def list_backups(base_filename, naming):
+    """
+
+    Function to list the rotated files of a log file, oldest first
+
+    :param base_filename: Path of the log file
+    :type base_filename: str
+    :param naming: Naming scheme of the rotated files. Options: 'timestamp' | 'sequence'
+    :type naming: str
+    :return: Paths of the rotated files
+    :rtype: list
+
+    """
+    return [filename for _, filename in _scan_backups(base_filename, naming)]
+
+
+def _scan_backups(base_filename, naming):
+    # Sorted (sequence number or timestamp suffix, path) of the rotated files
+    directory, base_name = os.path.split(base_filename)
+    prefix = base_name + '.'
+    backups = []
+    for file_name in os.listdir(directory):
+        if not file_name.startswith(prefix):
+            continue
+        suffix = file_name[len(prefix):]
+        for extension in COMPRESSIONS.values():
+            if suffix.endswith(extension):
+                suffix = suffix[:-len(extension)]
+                break
+        if naming == 'sequence':
+            if suffix.isdigit():
+                backups.append((int(suffix), file_name))
+        elif _TIMESTAMP_SUFFIX.match(suffix):
+            backups.append((suffix, file_name))
+    backups.sort()
+    return [(key, os.path.join(directory, file_name)) for key, file_name in backups]
+
+
+class Metrics(object):
+    """
+    Counters and duration histograms of the handlers of one logger.
+
+    Each thread updates its own dicts, without any lock, and snapshot()
+    merges the dicts of all threads. Counters and histograms are keyed by
+    metric name and label (the level name of a file, or '' if none).
+    Values kept by the handlers themselves, e.g. the queue depth, are read
+    through functions registered with register().
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._local = threading.local()
+        # Thread and (counters, histograms) of every thread which updated a metric
+        self._threads = []
+        # Values of threads which have exited
+        self._retired = ({}, {})
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def _values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = ({}, {})
+            with self._lock:
+                self._threads.append((threading.current_thread(), values))
+            return values
+
+    def increment(self, metric, label='', value=1):
+        counters = self._values()[0]
+        key = (metric, label)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, metric, label, seconds):
+        histograms = self._values()[1]
+        key = (metric, label)
+        histogram = histograms.get(key)
+        if histogram is None:
+            # Count, sum, then one count per bucket and one above the last bucket
+            histogram = histograms[key] = [0, 0.0] + [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        histogram[0] += 1
+        histogram[1] += seconds
+        histogram[2 + bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+
+    def emitted(self, label, size, seconds):
+        """
+        Count a record of 'size' bytes written to the file of 'label' in 'seconds'.
+        """
+        counters, histograms = self._values()
+        key = ('records_total', label)
+        counters[key] = counters.get(key, 0) + 1
+        key = ('bytes_total', label)
+        counters[key] = counters.get(key, 0) + size
+        key = ('emit_seconds', label)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0, 0.0] + [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        histogram[0] += 1
+        histogram[1] += seconds
+        histogram[2 + bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1
+
+    def register(self, metric, function, kind='gauge'):
+        """
+        Read the metric by calling 'function' on each snapshot. 'kind' is 'gauge' or 'counter'.
+        """
+        self._callbacks[metric] = (kind, function)
+
+    @staticmethod
+    def _merge(target, values):
+        counters, histograms = target
+        # Copying a dict is atomic, so the owning thread may go on updating it
+        for key, value in dict(values[0]).items():
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in dict(values[1]).items():
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = list(histogram)
+            else:
+                histograms[key] = [a + b for a, b in zip(total, list(histogram))]
+
+    def snapshot(self):
+        """
+
+        :return: Counters, histograms and gauges, as {'counters': {metric: {label: value}}, 'histograms': {metric:
+            {label: {'count', 'sum', 'buckets': {upper bound: cumulative count}}}}, 'gauges': {metric: value}}
+        :rtype: dict
+
+        """
+        merged = ({}, {})
+        with self._lock:
+            alive = []
+            for thread, values in self._threads:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    self._merge(self._retired, values)
+            self._threads = alive
+            self._merge(merged, self._retired)
+            for _, values in alive:
+                self._merge(merged, values)
+
+        stats = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        for (metric, label), value in merged[0].items():
+            stats['counters'].setdefault(metric, {})[label] = value
+        for (metric, label), histogram in merged[1].items():
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS + (float('inf'),), histogram[2:]):
+                cumulative += count
+                buckets[bound] = cumulative
+            stats['histograms'].setdefault(metric, {})[label] = {'count': histogram[0], 'sum': histogram[1],
+                                                                 'buckets': buckets}
+        for metric, (kind, function) in self._callbacks.items():
+            stats['counters' if kind == 'counter' else 'gauges'][metric] = {'': function()}
+        return stats
+
+    def prometheus(self):
+        """
+
+        :return: Metrics in the Prometheus text exposition format, see prometheus_text
+        :rtype: str
+
+        """
+        return prometheus_text({self.name: self.snapshot()})
+
+
+def _prometheus_escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(snapshots):
+    """
+
+    Function to render metrics snapshots in the Prometheus text exposition format
+
+    Metrics are named 'autopylogger_<metric>', with a 'log' label and a 'level' label for those of a level file.
+
+    :param snapshots: Metrics.snapshot() of each log, by log name
+    :type snapshots: dict
+    :return: Metrics text
+    :rtype: str
+
+    """
+    def labels(log_name, label, extra=''):
+        text = 'log="%s"' % _prometheus_escape(log_name)
+        if label:
+            text += ',level="%s"' % _prometheus_escape(label)
+        return '{%s%s}' % (text, extra)
+
+    # Samples of each metric family, as all samples of a family must follow its TYPE line
+    families = {}
+    for log_name, stats in sorted(snapshots.items()):
+        for kind in ('counters', 'gauges'):
+            for metric, values in stats[kind].items():
+                family = families.setdefault(metric, ('counter' if kind == 'counters' else 'gauge', []))
+                for label, value in sorted(values.items()):
+                    family[1].append('autopylogger_%s%s %s' % (metric, labels(log_name, label), value))
+        for metric, values in stats['histograms'].items():
+            family = families.setdefault(metric, ('histogram', []))
+            for label, histogram in sorted(values.items()):
+                for bound, count in histogram['buckets'].items():
+                    bound = '+Inf' if bound == float('inf') else repr(bound)
+                    family[1].append('autopylogger_%s_bucket%s %d' % (
+                        metric, labels(log_name, label, ',le="%s"' % bound), count))
+                family[1].append('autopylogger_%s_sum%s %r' % (metric, labels(log_name, label), histogram['sum']))
+                family[1].append('autopylogger_%s_count%s %d' % (metric, labels(log_name, label),
+                                                                 histogram['count']))
+
+    lines = []
+    for metric, (kind, samples) in sorted(families.items()):
+        lines.append('# TYPE autopylogger_%s %s' % (metric, kind))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+# Metrics of each logger set up with enable_metrics, by log name
+_metrics = {}
+
+
+def get_stats(log_name='logger'):
+    """
+
+    Function to get the metrics of a logger set up by init_logging with enable_metrics
+
+    :param log_name: Name of log
+    :type log_name: str
+    :return: Counters (records_total, bytes_total, rotations_total, mails_sent_total, ...), histograms (emit_seconds,
+        rotation_seconds, mail_send_seconds) and gauges (queue_depth), see Metrics.snapshot
+    :rtype: dict
+
+    """
+    if log_name not in _metrics:
+        raise ArgumentError('No metrics for log %r. Pass enable_metrics=True to init_logging.' % log_name)
+    return _metrics[log_name].snapshot()
+
+
+def get_prometheus_stats(log_name=None):
+    """
+
+    Function to get the metrics of loggers in the Prometheus text exposition format
+
+    :param log_name: Name of log, or None for all loggers set up with enable_metrics
+    :type log_name: str or None
+    :return: Metrics text, e.g. to serve on a /metrics endpoint
+    :rtype: str
+
+    """
+    if log_name is not None:
+        if log_name not in _metrics:
+            raise ArgumentError('No metrics for log %r. Pass enable_metrics=True to init_logging.' % log_name)
+        return _metrics[log_name].prometheus()
+    return prometheus_text({name: metrics.snapshot() for name, metrics in _metrics.items()})
+
+
+class TrackedFileMixin(object):
+    """
+    Write path shared by the rotating file handlers of autopylogger.
+
+    The size of the current file is tracked in 'bytesWritten', which is
+    measured when the file is opened and then increased by the encoded
+    length of every record written. So the rollover check needs neither a
+    seek/tell on the stream nor a call to the clock, and each record is
+    formatted once, both to measure it and to write it.
+
+    With a 'bufferSize', records are collected in a user-space buffer of
+    that many bytes instead of being flushed one by one. The buffer is
+    written out when it is full, when 'flushInterval' seconds have passed
+    since the last flush, right away for records of 'flushLevel' or
+    above, and before every rollover and close.
+
+    With a 'rotationNaming' of 'timestamp' or 'sequence', a rollover only
+    renames the current file to a new unique name ('<file>.<date>-<time>-
+    <microseconds>' or '<file>.<n>' with n growing), so no older backup
+    is shifted. Compressing the rotated file ('compression' of 'gzip' or
+    'zstd') and removing backups beyond 'backupCount' happen on a
+    background thread. A 'backupCount' of 0 keeps every backup.
+
+    With 'binary', the file is opened in binary mode and written with the
+    bytes returned by the formatter, e.g. StructuredFormatter('msgpack').
+
+    With an 'indexEvery', a sidecar index '.index/<file name>.idx' is kept
+    next to the file: an INDEX_ENTRY (creation time, offset) is appended
+    for the first record of the file, then every 'indexEvery' records or
+    'indexInterval' seconds. The index is renamed and removed together with
+    the file, so readers can jump to a time range, see autopylogger.reader.
+
+    With 'metrics' (a Metrics object), the records, bytes and time spent in
+    emit and the rollovers and their duration are counted under the label
+    'metricsLabel'.
+
+    Missing directories of the file are made when it is first opened, and
+    the open files are kept in the shared FilePool, which may close them
+    between records. The mode is only used for the first open, the file is
+    reopened in append mode.
+    """
+
+    maxBytes = 0
+    rolloverAt = float('inf')
+    bytesWritten = 0
+    bufferSize = 0
+    flushInterval = 1.0
+    flushLevel = logging.ERROR
+    lastFlush = 0.0
+    rotationNaming = None
+    compression = None
+    binary = False
+    indexEvery = 0
+    indexInterval = 1.0
+    metrics = None
+    metricsLabel = ''
+    _index_stream = None
+    _index_pending = 0
+    _index_last = 0.0
+    _sequence = None
+    _last_stamp = None
+    _rotatable = True
+    _dirty = False
+
+    def _init_buffering(self, bufferSize, flushInterval, flushLevel):
+        # Must run before the base class opens the stream
+        self.bufferSize = bufferSize
+        self.flushInterval = flushInterval
+        self.flushLevel = flushLevel
+
+    def _init_rotation(self, rotationNaming, compression):
+        self.rotationNaming = rotationNaming
+        self.compression = compression
+
+    def _init_output(self, binary, indexEvery):
+        # With 'binary', the file is opened in binary mode and the formatter returns bytes
+        self.binary = binary
+        if binary:
+            self.terminator = b''
+        self.indexEvery = indexEvery
+
+    def _init_tracking(self):
+        # Encoding actually used by the stream, to measure records in bytes
+        stream_encoding = self.encoding
+        if stream_encoding in (None, 'locale'):
+            stream_encoding = locale.getpreferredencoding(False)
+        self._stream_encoding = codecs.lookup(stream_encoding).name
+        self._ascii_compatible = 'ascii\n'.encode(self._stream_encoding) == b'ascii\n'
+        # Extra bytes per newline written in text mode, e.g. '\r\n' on Windows
+        self._newline_extra = len(os.linesep) - 1
+
+        if self.stream is None and os.path.exists(self.baseFilename):
+            self.bytesWritten = os.path.getsize(self.baseFilename)
+
+        if self.bufferSize:
+            _buffer_flusher.register(self)
+
+    def _open(self):
+        try:
+            stream = self._open_stream()
+        except FileNotFoundError:
+            # The log directories are made with the first file opened in them
+            os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+            stream = self._open_stream()
+        # A file closed by the pool, or made by a rollover, is never truncated
+        self.mode = 'a'
+        file_stat = os.fstat(stream.fileno())
+        self.bytesWritten = file_stat.st_size
+        # See bpo-45401: Never rollover anything other than regular files
+        self._rotatable = stat.S_ISREG(file_stat.st_mode)
+        self.lastFlush = time.time()
+        if _file_pool.max_open:
+            _file_pool.opened(self)
+        return stream
+
+    def _open_stream(self):
+        if self.binary:
+            mode = self.mode if 'b' in self.mode else self.mode + 'b'
+            return open(self.baseFilename, mode, buffering=self.bufferSize or -1)
+        elif self.bufferSize:
+            return open(self.baseFilename, self.mode, buffering=self.bufferSize, encoding=self.encoding,
+                        errors=self.errors)
+        return super()._open()
+
+    def discard_buffer(self):
+        """
+        Drop the records waiting in the buffer without writing them. Called in
+        a forked child, where they are a copy of records the parent writes.
+        The file is reopened with the next record.
+        """
+        if self._dirty:
+            _discard_stream(self.stream)
+            _discard_stream(self._index_stream)
+            self.stream = None
+            self._index_stream = None
+            self._dirty = False
+
+    def release_stream(self):
+        """
+        Close the file and its index until the next record, which reopens
+        them. Called by the file pool with the lock held.
+        """
+        if self.stream is not None:
+            stream, self.stream = self.stream, None
+            # Closing writes out the buffer
+            stream.close()
+            self._dirty = False
+        self._close_index()
+
+    def _encoded_length(self, msg):
+        """
+        Length of the message in bytes once written to the file.
+        """
+        if self.binary:
+            return len(msg)
+        if self._ascii_compatible and msg.isascii():
+            size = len(msg)
+        else:
+            size = len(msg.encode(self._stream_encoding, self.errors or 'strict'))
+        if self._newline_extra:
+            size += msg.count('\n') * self._newline_extra
+        return size
+
+    def _exceeds_size(self, size):
+        # An empty file is never rotated, even if a single record is larger than maxBytes
+        return 0 < self.maxBytes <= self.bytesWritten + size and self.bytesWritten > 0
+
+    def shouldRollover(self, record):
+        """
+        Determine if rollover should occur.
+
+        Basically, see if the supplied record would cause the file to exceed
+        the size limit we have, or if it was created after the rollover time.
+        """
+        if not self._rotatable:
+            return 0
+
+        # Time based rotation condition
+        if record.created >= self.rolloverAt:
+            return 1
+
+        # Size based rotation condition
+        if self.maxBytes > 0:
+            if self._exceeds_size(self._encoded_length(self.format(record) + self.terminator)):
+                return 1
+        return 0
+
+    def doRollover(self):
+        started = time.perf_counter() if self.metrics is not None else None
+        self._close_index()
+        if self.rotationNaming is None:
+            if self.indexEvery:
+                self._shift_indexes()
+            super().doRollover()
+            if self.indexEvery and isinstance(self, TimedRotatingFileHandler):
+                self._prune_indexes()
+        else:
+            self._rollover_to_backup()
+        if self.stream is None:                 # delay was set...
+            self.bytesWritten = 0
+        if started is not None:
+            self.metrics.increment('rotations_total', self.metricsLabel)
+            self.metrics.observe('rotation_seconds', self.metricsLabel, time.perf_counter() - started)
+
+    def _rollover_to_backup(self):
+        """
+        Rename the current file to a new unique backup name and hand compression
+        and pruning over to the rotation worker.
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        backup_filename = self._backup_filename()
+        try:
+            os.rename(self.baseFilename, backup_filename)
+        except FileNotFoundError:
+            pass
+        else:
+            self._move_index(self.baseFilename, backup_filename)
+            _rotation_worker.submit(backup_filename, self.baseFilename, self.backupCount, self.rotationNaming,
+                                    self.compression)
+        if isinstance(self, TimedRotatingFileHandler):
+            self.rolloverAt = self._next_rollover_time()
+        if not self.delay:
+            self.stream = self._open()
+
+    def rotate(self, source, dest):
+        super().rotate(source, dest)
+        self._move_index(source, dest)
+
+    def _move_index(self, source, dest):
+        if self.indexEvery:
+            try:
+                os.replace(index_filename(source), index_filename(dest))
+            except FileNotFoundError:
+                pass
+
+    def _shift_indexes(self):
+        # RotatingFileHandler shifts '<file>.i' to '<file>.i+1' itself, their indexes follow
+        if isinstance(self, RotatingFileHandler) and self.backupCount > 0:
+            for i in range(self.backupCount - 1, 0, -1):
+                self._move_index('%s.%d' % (self.baseFilename, i), '%s.%d' % (self.baseFilename, i + 1))
+
+    def _prune_indexes(self):
+        # TimedRotatingFileHandler removes old backups itself, their indexes are removed after them
+        index_directory = os.path.dirname(index_filename(self.baseFilename))
+        prefix = os.path.basename(self.baseFilename) + '.'
+        try:
+            index_names = os.listdir(index_directory)
+        except FileNotFoundError:
+            return
+        directory = os.path.dirname(self.baseFilename)
+        for index_name in index_names:
+            if index_name.startswith(prefix) and index_name.endswith('.idx'):
+                file_name = os.path.join(directory, index_name[:-len('.idx')])
+                if not any(os.path.exists(file_name + extension) for extension in ('',) + tuple(COMPRESSIONS.values())):
+                    os.remove(os.path.join(index_directory, index_name))
+
+    def _write_index(self, created):
+        if self._index_stream is None:
+            filename = index_filename(self.baseFilename)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # A new or truncated log file starts a new index
+            self._index_stream = open(filename, 'ab' if self.bytesWritten else 'wb')
+        self._index_stream.write(INDEX_ENTRY.pack(created, self.bytesWritten))
+        self._index_pending = 0
+        self._index_last = created
+
+    def _close_index(self):
+        if self._index_stream is not None:
+            self._index_stream.close()
+            self._index_stream = None
+
+    def _backup_filename(self):
+        if self.rotationNaming == 'sequence':
+            if self._sequence is None:
+                # Continue after the newest existing backup
+                backups = _scan_backups(self.baseFilename, 'sequence')
+                self._sequence = backups[-1][0] if backups else 0
+            self._sequence += 1
+            return '%s.%d' % (self.baseFilename, self._sequence)
+
+        now = time.time()
+        # Backups of one handler always get increasing stamps, even within one microsecond
+        stamp = int(now * 1000000)
+        if self._last_stamp is not None and stamp <= self._last_stamp:
+            stamp = self._last_stamp + 1
+        self._last_stamp = stamp
+        seconds, microseconds = divmod(stamp, 1000000)
+        time_tuple = time.gmtime(seconds) if getattr(self, 'utc', False) else time.localtime(seconds)
+        return '%s.%s-%06d' % (self.baseFilename, time.strftime('%Y%m%d-%H%M%S', time_tuple), microseconds)
+
+    def _next_rollover_time(self):
+        current_time = int(time.time())
+        new_rollover_at = self.computeRollover(current_time)
+        while new_rollover_at <= current_time:
+            new_rollover_at = new_rollover_at + self.interval
+        # If DST changes and midnight or weekly rollover, adjust for this.
+        if (self.when == 'MIDNIGHT' or self.when.startswith('W')) and not self.utc:
+            dst_now = time.localtime(current_time)[-1]
+            dst_at_rollover = time.localtime(new_rollover_at)[-1]
+            if dst_now != dst_at_rollover:
+                if not dst_now:
+                    new_rollover_at -= 3600
+                else:
+                    new_rollover_at += 3600
+        return new_rollover_at
+
+    def isDirty(self):
+        """
+
+        :return: True if written records may still be waiting in the buffer
+        :rtype: bool
+
+        """
+        return self._dirty
+
+    def flush(self):
+        with self.lock:
+            super().flush()
+            if self._index_stream is not None:
+                self._index_stream.flush()
+            if self.bufferSize:
+                self._dirty = False
+                self.lastFlush = time.time()
+
+    def close(self):
+        if self.bufferSize:
+            _buffer_flusher.unregister(self)
+        _file_pool.discard(self)
+        with self.lock:
+            self._close_index()
+        super().close()
+
+    def emit(self, record):
+        """
+        Emit a record.
+
+        The record is formatted once, both to measure it and to write it.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter()
+        try:
+            msg = self.format(record) + self.terminator
+            size = self._encoded_length(msg)
+            if self._rotatable:
+                if record.created >= self.rolloverAt:
+                    self.doRollover()
+                elif self._exceeds_size(size):
+                    # A size based rollover does not move the next time based one
+                    rollover_at = self.rolloverAt
+                    self.doRollover()
+                    self.rolloverAt = rollover_at
+            if self.stream is None:
+                self.stream = self._open()
+            elif _file_pool.max_open:
+                _file_pool.used(self)
+            if self.indexEvery:
+                if (self._index_stream is None or self._index_pending >= self.indexEvery
+                        or record.created - self._index_last >= self.indexInterval):
+                    self._write_index(record.created)
+                self._index_pending += 1
+            self.stream.write(msg)
+            self.bytesWritten += size
+            if (not self.bufferSize or record.levelno >= self.flushLevel
+                    or record.created - self.lastFlush >= self.flushInterval):
+                self.flush()
+            else:
+                self._dirty = True
+            if metrics is not None:
+                metrics.emitted(self.metricsLabel, size, time.perf_counter() - started)
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
+class TrackedRotatingFileHandler(TrackedFileMixin, RotatingFileHandler):
+    """
+    Size based rotating file handler using the tracked byte count of
+    TrackedFileMixin, with optional buffering and rotation naming.
+    """
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0, encoding=None, delay=0,
+                 bufferSize=0, flushInterval=1.0, flushLevel=logging.ERROR, rotationNaming=None, compression=None,
+                 binary=False, indexEvery=0):
+        self._init_buffering(bufferSize, flushInterval, flushLevel)
+        self._init_rotation(rotationNaming, compression)
+        self._init_output(binary, indexEvery)
+        RotatingFileHandler.__init__(self, filename, mode, maxBytes, backupCount, encoding, delay)
+        self._init_tracking()
+
+
+class TrackedTimedRotatingFileHandler(TrackedFileMixin, TimedRotatingFileHandler):
+    """
+    Time based rotating file handler comparing the record creation time
+    with the rollover time, with optional buffering and rotation naming.
+    """
+
+    def __init__(self, filename, when='h', interval=1, backupCount=0, encoding=None, delay=0, utc=False,
+                 bufferSize=0, flushInterval=1.0, flushLevel=logging.ERROR, rotationNaming=None, compression=None,
+                 binary=False, indexEvery=0):
+        self._init_buffering(bufferSize, flushInterval, flushLevel)
+        self._init_rotation(rotationNaming, compression)
+        self._init_output(binary, indexEvery)
+        TimedRotatingFileHandler.__init__(self, filename, when, interval, backupCount, encoding, delay, utc)
+        self._init_tracking()
+
+
+class SizedTimedRotatingFileHandler(TrackedFileMixin, TimedRotatingFileHandler):
     """
     Handler for logging to a set of files, which switches from one file
     to the next when the current file reaches a certain size, or at certain
@@ -16,33 +1031,1129 @@ class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
     """
 
     def __init__(self, filename, maxBytes=0, backupCount=0, encoding=None,
-                 delay=0, when='h', interval=1, utc=False):
+                 delay=0, when='h', interval=1, utc=False,
+                 bufferSize=0, flushInterval=1.0, flushLevel=logging.ERROR, rotationNaming=None, compression=None,
+                 binary=False, indexEvery=0):
+        self._init_buffering(bufferSize, flushInterval, flushLevel)
+        self._init_rotation(rotationNaming, compression)
+        self._init_output(binary, indexEvery)
+        self._counter = None
         TimedRotatingFileHandler.__init__(
             self, filename, when, interval, backupCount, encoding, delay, utc)
         self.maxBytes = maxBytes
+        self._init_tracking()
 
-    def shouldRollover(self, record):
+    def rotation_filename(self, default_name):
         """
-        Determine if rollover should occur.
+        Several size based rollovers can happen in one time interval, and all of
+        them get the same time suffix. A zero-padded counter is appended to the
+        name, which only grows and is never reused (it continues after the
+        newest existing backup), so no rotated file is overwritten and the
+        backups sort by age.
+        """
+        name = TimedRotatingFileHandler.rotation_filename(self, default_name)
+        if self._counter is None:
+            backups = self._counted_backups()
+            self._counter = backups[-1][0][0] if backups else 0
+        self._counter += 1
+        return '%s.%06d' % (name, self._counter)
+
+    def getFilesToDelete(self):
+        """
+        Determine the files to delete when rolling over: the oldest backups by
+        counter beyond 'backupCount'.
+        """
+        backups = self._counted_backups()
+        if len(backups) <= self.backupCount:
+            return []
+        return [filename for _, filename in backups[:len(backups) - self.backupCount]]
+
+    def _counted_backups(self):
+        # Sorted ((counter, suffix), path) of the rotated files, backups without a counter first
+        directory, base_name = os.path.split(self.baseFilename)
+        prefix = base_name + '.'
+        backups = []
+        for file_name in os.listdir(directory):
+            if not file_name.startswith(prefix):
+                continue
+            suffix = file_name[len(prefix):]
+            for extension in COMPRESSIONS.values():
+                if suffix.endswith(extension):
+                    suffix = suffix[:-len(extension)]
+                    break
+            stamp, _, counter = suffix.partition('.')
+            if not self.extMatch.match(stamp):
+                continue
+            key = (int(counter), suffix) if counter.isdigit() else (0, suffix)
+            backups.append((key, os.path.join(directory, file_name)))
+        backups.sort()
+        return backups
+
+
+class LeanLogRecord(logging.LogRecord):
+    """
+    Log record which leaves out the thread and process fields that are
+    not used. Fields left out are None.
+    """
 
-        Basically, see if the supplied record would cause the file to exceed
-        the size limit we have.
+    def __init__(self, name, level, pathname, lineno, msg, args, exc_info, func=None, sinfo=None,
+                 with_thread=True, with_process_name=True, with_process=True, with_task_name=True):
+        ct = time.time()
+        self.name = name
+        self.msg = msg
+        # Allows passing of a dictionary as a sole argument, as in logging.LogRecord
+        if args and len(args) == 1 and isinstance(args[0], collections.abc.Mapping) and args[0]:
+            args = args[0]
+        self.args = args
+        self.levelname = logging.getLevelName(level)
+        self.levelno = level
+        self.pathname = pathname
+        try:
+            self.filename = os.path.basename(pathname)
+            self.module = os.path.splitext(self.filename)[0]
+        except (TypeError, ValueError, AttributeError):
+            self.filename = pathname
+            self.module = "Unknown module"
+        self.exc_info = exc_info
+        self.exc_text = None      # used to cache the traceback text
+        self.stack_info = sinfo
+        self.lineno = lineno
+        self.funcName = func
+        self.created = ct
+        self.msecs = int((ct - int(ct)) * 1000) + 0.0  # see gh-89047
+        self.relativeCreated = (self.created - logging._startTime) * 1000
+        if with_thread and logging.logThreads:
+            self.thread = threading.get_ident()
+            self.threadName = threading.current_thread().name
+        else:
+            self.thread = None
+            self.threadName = None
+        self.processName = None
+        if with_process_name and logging.logMultiprocessing:
+            self.processName = 'MainProcess'
+            mp = sys.modules.get('multiprocessing')
+            if mp is not None:
+                try:
+                    self.processName = mp.current_process().name
+                except Exception:
+                    pass
+        if with_process and logging.logProcesses and hasattr(os, 'getpid'):
+            self.process = os.getpid()
+        else:
+            self.process = None
+        # Name of the running asyncio task, only on Python 3.12+ where logging.LogRecord has it
+        if hasattr(logging, 'logAsyncioTasks'):
+            self.taskName = None
+            if with_task_name and logging.logAsyncioTasks:
+                try:
+                    self.taskName = asyncio.current_task().get_name()
+                except Exception:
+                    pass
+
+
+class FastLogger(logging.Logger):
+    """
+    Logger which only computes the record fields that are used, see
+    set_record_fields.
+
+    If no caller field (pathname, filename, module, lineno, funcName) is
+    used, the stack walk of findCaller is skipped. Otherwise the walk
+    decides which frames belong to the logging module once per code object,
+    instead of comparing file names on every call. Thread and process
+    fields which are not used are left as None.
+    """
+
+    find_caller = True
+    record_fields = None
+    # With a flight recorder, records from this level up are made even below the logger level, see set_level
+    capture_level = None
+    _lean_record = None
+
+    def isEnabledFor(self, level):
         """
+        Is this logger enabled for level 'level'? With a capture level, records
+        below the logger level are made too, for the flight recorder to keep.
+        """
+        capture_level = self.capture_level
+        if capture_level is not None and level >= capture_level and not self.disabled:
+            return self.manager.disable < level
+        return logging.Logger.isEnabledFor(self, level)
 
-        # Size based rotation condition
-        if self.stream is None:                 # delay was set...
-            self.stream = self._open()
-        if self.maxBytes > 0:                   # are we rolling over?
-            msg = "%s\n" % self.format(record)
-            self.stream.seek(0, 2)  # due to non-posix-compliant Windows feature
-            if self.stream.tell() + len(msg) >= self.maxBytes:
-                return 1
+    def set_record_fields(self, fields):
+        """
+        Set the record attributes used by the handlers of this logger, None for all.
+        """
+        self.record_fields = fields
+        if fields is None:
+            self.find_caller = True
+            self._lean_record = None
+            return
+        self.find_caller = not CALLER_FIELDS.isdisjoint(fields)
+        flags = (not THREAD_FIELDS.isdisjoint(fields), 'processName' in fields, 'process' in fields,
+                 'taskName' in fields)
+        self._lean_record = None if all(flags) else flags
+
+    def findCaller(self, stack_info=False, stacklevel=1):
+        """
+        Find the stack frame of the caller so that we can note the source
+        file name, line number and function name.
+        """
+        if not self.find_caller and not stack_info:
+            return UNKNOWN_CALLER
+        f = sys._getframe()
+        while stacklevel > 0:
+            next_f = f.f_back
+            if next_f is None:
+                break
+            f = next_f
+            code = f.f_code
+            internal = _internal_codes.get(code)
+            if internal is None:
+                if len(_internal_codes) >= 4096:
+                    _internal_codes.clear()
+                internal = _internal_codes[code] = _is_internal_filename(code.co_filename)
+            if not internal:
+                stacklevel -= 1
+        co = f.f_code
+        sinfo = None
+        if stack_info:
+            with io.StringIO() as sio:
+                sio.write("Stack (most recent call last):\n")
+                traceback.print_stack(f, file=sio)
+                sinfo = sio.getvalue()
+                if sinfo[-1] == '\n':
+                    sinfo = sinfo[:-1]
+        return co.co_filename, f.f_lineno, co.co_name, sinfo
+
+    def makeRecord(self, name, level, fn, lno, msg, args, exc_info, func=None, extra=None, sinfo=None):
+        if self._lean_record is None or logging.getLogRecordFactory() is not logging.LogRecord:
+            return logging.Logger.makeRecord(self, name, level, fn, lno, msg, args, exc_info, func, extra, sinfo)
+        rv = LeanLogRecord(name, level, fn, lno, msg, args, exc_info, func, sinfo, *self._lean_record)
+        if extra is not None:
+            for key in extra:
+                if (key in ["message", "asctime"]) or (key in rv.__dict__):
+                    raise KeyError("Attempt to overwrite %r in LogRecord" % key)
+                rv.__dict__[key] = extra[key]
+        return rv
+
+
+# Whether a code object belongs to the logging module, by code object
+_internal_codes = {}
+
+
+def _is_internal_filename(filename):
+    # Same test as logging._is_internal_frame
+    filename = os.path.normcase(filename)
+    return filename == logging._srcfile or ("importlib" in filename and "_bootstrap" in filename)
+
+
+def format_fields(log_format):
+    """
 
-        # Time based rotation condition
-        t = int(time.time())
-        if t >= self.rolloverAt:
-            return 1
-        return 0
+    Function to list the record attributes used by a %-style log format
+
+    :param log_format: Log format
+    :type log_format: str
+    :return: Names of the record attributes
+    :rtype: frozenset
+
+    """
+    return frozenset(_FORMAT_FIELD.findall(log_format.replace('%%', '')))
+
+
+def set_filters(log, filters):
+    """
+
+    Function to replace the rate limit, sampling and repeat filters of a logger
+
+    :param log: Logger object
+    :type log: Logger
+    :param filters: New filters
+    :type filters: list
+    :return: None
+
+    """
+    for log_filter in list(log.filters):
+        if isinstance(log_filter, (RateLimitFilter, SamplingFilter, RepeatFilter)):
+            log.removeFilter(log_filter)
+    for log_filter in filters:
+        log.addFilter(log_filter)
+
+
+def flight_recorder_of(log):
+    """
+
+    Function to find the flight recorder of a logger
+
+    :param log: Logger object
+    :type log: Logger
+    :return: FlightRecorderFilter shared by the handlers of the logger, or None
+    :rtype: FlightRecorderFilter or None
+
+    """
+    for handler in log.handlers:
+        for handler_filter in handler.filters:
+            if isinstance(handler_filter, FlightRecorderFilter):
+                return handler_filter
+    return None
+
+
+def set_flight_recorder(log, recorder):
+    """
+
+    Function to replace the flight recorder of a logger, a filter shared by the handlers of the logger
+
+    The handlers run after the logger filters, and also for the records propagated from child loggers.
+
+    :param log: Logger object
+    :type log: Logger
+    :param recorder: New flight recorder, or None for none
+    :type recorder: FlightRecorderFilter or None
+    :return: None
+
+    """
+    for handler in log.handlers:
+        for handler_filter in list(handler.filters):
+            if isinstance(handler_filter, FlightRecorderFilter):
+                handler.removeFilter(handler_filter)
+        if recorder is not None:
+            handler.addFilter(recorder)
+
+
+def set_level(log, level):
+    """
+
+    Function to set the level of a logger, following the flight recorder it already has
+
+    With a FlightRecorderFilter, the level is also set on the filter, which keeps the records below it. A
+    FastLogger keeps its level and makes the records below it for the recorder, see FastLogger.capture_level;
+    other loggers are set to DEBUG.
+
+    :param log: Logger object
+    :type log: Logger
+    :param level: Log level
+    :type level: int
+    :return: None
+
+    """
+    recorder = flight_recorder_of(log)
+    if recorder is not None:
+        recorder.level = level
+    if isinstance(log, FastLogger):
+        log.capture_level = None if recorder is None else logging.DEBUG
+    elif recorder is not None:
+        level = logging.DEBUG
+    log.setLevel(level)
+
+
+def handler_fields(handler):
+    """
+
+    Function to list the record attributes used by a handler, from the log format of its formatter
+
+    :param handler: Log handler
+    :type handler: Handler
+    :return: Names of the record attributes, or None if they cannot be told, e.g. for a '{' style formatter
+    :rtype: frozenset or None
+
+    """
+    formatter = handler.formatter or logging._defaultFormatter
+    if isinstance(formatter, StructuredFormatter):
+        return frozenset(formatter.fields)
+    if isinstance(handler, QueueHandler) or type(formatter._style) is not logging.PercentStyle:
+        # Records queued to another thread can be formatted there with any format
+        return None
+    return format_fields(formatter._fmt)
+
+
+def use_record_fields(log, fields):
+    """
+
+    Function to make a logger compute only the record fields that are used, see FastLogger
+
+    A plain logging.Logger is turned into a FastLogger; loggers of other classes are left as they are.
+    If the logger propagates its records, the fields used by the handlers of its ancestors are added, see
+    handler_fields. Handlers added to the ancestors later are not taken into account.
+
+    :param log: Logger object
+    :type log: Logger
+    :param fields: Names of the record attributes used by the handlers of the logger, or None for all
+    :type fields: frozenset or None
+    :return: None
+
+    """
+    ancestor = log.parent if log.propagate else None
+    while ancestor is not None and fields is not None:
+        for handler in ancestor.handlers:
+            used = handler_fields(handler)
+            if used is None:
+                fields = None
+                break
+            fields = fields | used
+        ancestor = ancestor.parent if ancestor.propagate else None
+    if type(log) is logging.Logger:
+        log.__class__ = FastLogger
+    if isinstance(log, FastLogger):
+        log.set_record_fields(fields)
+
+
+def compile_format(fmt):
+    """
+
+    Function to compile a %-style format string into a render function
+
+    The fields are replaced by positional conversions with the same flags, e.g. '%(levelname)-8s' by '%-8s', so
+    rendering takes the values from the dict by position and gives the same text as 'fmt % values'.
+
+    :param fmt: %-style format string, e.g. '%(asctime)s - %(message)s'
+    :type fmt: str
+    :return: Function rendering a dict of record attributes. It raises ValueError for a field not in the dict.
+    :rtype: function
+
+    """
+    names = []
+
+    def positional(match):
+        if match.group(1) is None:
+            return '%%'
+        names.append(match.group(1))
+        return '%'
+
+    template = _FORMAT_TOKEN.sub(positional, fmt)
+    if not names:
+        text = template % ()
+        return lambda values: text
+    getter = itemgetter(*names)
+    single = len(names) == 1
+
+    def render(values):
+        try:
+            fields = getter(values)
+        except KeyError as e:
+            raise ValueError('Formatting field not found in record: %s' % e)
+        return template % ((fields,) if single else fields)
+
+    return render
+
+
+class CachedTimeMixin(object):
+    """
+    formatTime which renders the date and time of a second only once, as
+    records of the same second differ only by their milliseconds. The text
+    is the same as logging.Formatter.formatTime. With 'utc', times are in
+    UTC instead of local time.
+    """
+
+    def _init_time_cache(self, utc):
+        self.utc = utc
+        if utc:
+            self.converter = time.gmtime
+        # Second, date format and rendered text, replaced as one tuple so threads never see them mismatched
+        self._time_cache = (None, None, None)
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        cached_second, cached_datefmt, text = self._time_cache
+        if cached_second != second or cached_datefmt != datefmt:
+            text = time.strftime(datefmt or self.default_time_format, self.converter(record.created))
+            self._time_cache = (second, datefmt, text)
+        if datefmt or not self.default_msec_format:
+            return text
+        return self.default_msec_format % (text, record.msecs)
+
+
+class CachingFormatter(CachedTimeMixin, logging.Formatter):
+    """
+    Formatter which renders each record only once. The text is kept on
+    the record, so every handler sharing this formatter (console, level
+    file, SMTP, rollover size checks) reuses it instead of formatting the
+    message and the time again.
+
+    The date and time of %(asctime)s are rendered once per second, and a
+    %-style format is compiled once into a render function, see
+    compile_format. The text is the same as with logging.Formatter.
+    """
+
+    def __init__(self, fmt=None, datefmt=None, style='%', validate=True, utc=False):
+        logging.Formatter.__init__(self, fmt, datefmt, style, validate)
+        self._init_time_cache(utc)
+        self._render = compile_format(self._fmt) if style == '%' else None
+        # Record attribute holding the text rendered by this formatter
+        self._cache_attr = '_formatted_%x' % id(self)
+
+    def formatMessage(self, record):
+        if self._render is None:
+            return logging.Formatter.formatMessage(self, record)
+        return self._render(record.__dict__)
+
+    def format(self, record):
+        text = record.__dict__.get(self._cache_attr)
+        if text is None:
+            text = logging.Formatter.format(self, record)
+            setattr(record, self._cache_attr, text)
+        return text
+
+
+def exception_frames(exc_info):
+    """
+
+    Function to describe an exception as structured data instead of a rendered traceback
+
+    :param exc_info: Exception info tuple, as in record.exc_info
+    :type exc_info: tuple
+    :return: Type, message and frames (filename, lineno, function, line) of the exception
+    :rtype: dict
+
+    """
+    exc_type, exc_value, exc_traceback = exc_info
+    if exc_type is None:
+        return {'type': None, 'message': None, 'frames': []}
+    if exc_type.__module__ == 'builtins':
+        type_name = exc_type.__qualname__
+    else:
+        type_name = '%s.%s' % (exc_type.__module__, exc_type.__qualname__)
+    return {
+        'type': type_name,
+        'message': str(exc_value),
+        'frames': [{'filename': frame.filename, 'lineno': frame.lineno, 'function': frame.name, 'line': frame.line}
+                   for frame in traceback.extract_tb(exc_traceback)],
+    }
+
+
+class StructuredFormatter(CachedTimeMixin, logging.Formatter):
+    """
+    Formatter which serializes each record as one JSON object ('jsonl',
+    one per line) or as one MessagePack map ('msgpack'), so the log files
+    can be read back without parsing text.
+
+    The requested 'fields' are compiled once into the record attributes
+    to copy and the computed ones ('message', 'asctime'). Attributes
+    passed with 'extra' are written under 'extra', and an exception under
+    'exc_info' with its type, message and frames. One JSON encoder or
+    MessagePack packer is kept and reused for every record, so the
+    formatter is meant for a single handler, which formats under its lock.
+    'asctime' is rendered as by CachingFormatter, with 'datefmt' and 'utc'.
+    """
+
+    def __init__(self, fields, output_format='jsonl', datefmt=None, utc=False):
+        logging.Formatter.__init__(self, datefmt=datefmt)
+        self._init_time_cache(utc)
+        self.output_format = output_format
+        self.fields = tuple(dict.fromkeys(fields))
+        self._attributes = tuple(name for name in self.fields if name not in ('message', 'asctime'))
+        self._with_message = 'message' in self.fields
+        self._with_asctime = 'asctime' in self.fields
+        if output_format == 'msgpack':
+            import msgpack
+            self._encode = msgpack.Packer(default=str, use_bin_type=True).pack
+        else:
+            self._encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str).encode
+
+    def serialize(self, record):
+        """
+        Fields of the record as a dict, ready to be encoded.
+        """
+        attributes = record.__dict__
+        data = {name: attributes.get(name) for name in self._attributes}
+        if self._with_asctime:
+            data['asctime'] = self.formatTime(record, self.datefmt)
+        if self._with_message:
+            data['message'] = record.getMessage()
+
+        extra = {key: value for key, value in attributes.items()
+                 if key not in _RECORD_ATTRIBUTES and key[0] != '_'}
+        if extra:
+            data['extra'] = extra
+
+        if record.exc_info:
+            data['exc_info'] = exception_frames(record.exc_info)
+        elif attributes.get('exc_frames'):
+            # Record serialized by a worker process, see CollectorClientHandler
+            data['exc_info'] = attributes['exc_frames']
+        elif record.exc_text:
+            data['exc_info'] = {'text': record.exc_text}
+        if record.stack_info:
+            data['stack_info'] = record.stack_info
+        return data
+
+    def format(self, record):
+        return self._encode(self.serialize(record))
+
+
+class LevelRoutingFileHandler(logging.Handler):
+    """
+    Handler which writes each record to the file of its level, i.e.
+    '<log_name>.debug', '.info', '.warn' or '.error' in the Debug, Info,
+    Warning and Error directories of the log path.
+
+    The target file is looked up by level number in a table built once,
+    so a record costs one lookup and one lock instead of a level check,
+    a filter call and a lock on each of four handlers. Records of any
+    other level (e.g. CRITICAL) are not written to a file.
+
+    With 'binary', the files are written in binary mode, for a formatter
+    returning bytes such as StructuredFormatter('msgpack'). With an
+    'indexEvery', each file keeps a sidecar time index, and with 'metrics'
+    each file is counted under its level name, see TrackedFileMixin.
+    """
+
+    def __init__(self, logs_path, log_name, rotation_criteria='size', mode='a', maxBytes=0, backupCount=0,
+                 encoding=None, delay=0, when='h', interval=1, utc=False, bufferSize=0, flushInterval=1.0,
+                 flushLevel=logging.ERROR, rotationNaming=None, compression=None, binary=False,
+                 indexEvery=0, metrics=None):
+        logging.Handler.__init__(self)
+        self.rotation_criteria = rotation_criteria.lower()
+        # Options common to the file handlers of all rotation criteria
+        self.file_options = dict(bufferSize=bufferSize, flushInterval=flushInterval, flushLevel=flushLevel,
+                                 rotationNaming=rotationNaming, compression=compression, binary=binary,
+                                 indexEvery=indexEvery)
+        self.routes = {}
+        for levelno, directory, extension in LEVEL_FILES:
+            filename = os.path.join(logs_path, directory, log_name + extension)
+            handler = self._make_file_handler(filename, mode, maxBytes, backupCount, encoding, delay, when,
+                                              interval, utc)
+            # The file handlers share our lock, so a background flush never races a write
+            handler.lock = self.lock
+            handler.metrics = metrics
+            handler.metricsLabel = logging.getLevelName(levelno)
+            self.routes[levelno] = handler
+
+    def _make_file_handler(self, filename, mode, maxBytes, backupCount, encoding, delay, when, interval, utc):
+        if self.rotation_criteria in ('timeandsize', 'sizeandtime'):
+            return SizedTimedRotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backupCount,
+                                                 encoding=encoding, delay=delay, when=when, interval=interval,
+                                                 utc=utc, **self.file_options)
+        elif self.rotation_criteria == 'time':
+            return TrackedTimedRotatingFileHandler(filename, when=when, interval=interval, backupCount=backupCount,
+                                                   encoding=encoding, delay=delay, utc=utc, **self.file_options)
+        else:
+            return TrackedRotatingFileHandler(filename, mode=mode, maxBytes=maxBytes, backupCount=backupCount,
+                                              encoding=encoding, delay=delay, **self.file_options)
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        for handler in self.routes.values():
+            handler.setFormatter(fmt)
+
+    def emit(self, record):
+        """
+        Write the record to the file of its level, rotating it if needed.
+        Records of the flight recorder attached to it are written to the
+        DEBUG file first, see FlightRecorderFilter.
+        """
+        flight_records = record.__dict__.get('flight_records')
+        if flight_records:
+            debug_handler = self.routes[logging.DEBUG]
+            for flight_record in flight_records:
+                debug_handler.emit(flight_record)
+        handler = self.routes.get(record.levelno)
+        if handler is not None:
+            # Called under our own lock, so the file handler lock is skipped
+            handler.emit(record)
+
+    def flush(self):
+        with self.lock:
+            for handler in self.routes.values():
+                handler.flush()
+
+    def close(self):
+        with self.lock:
+            for handler in self.routes.values():
+                handler.close()
+        logging.Handler.close(self)
+
+
+class CoalescingSMTPHandler(SMTPHandler):
+    """
+    Handler which sends critical records by email from a background
+    thread, so a logging call never waits for the mail server.
+
+    Records arriving within 'batch_window' seconds of the first one are
+    sent together as one digest email, in which identical records (same
+    level, message and traceback) are listed once with a count. At most
+    'rate_limit' emails are sent per minute; records arriving meanwhile
+    are kept for the next digest. The SMTP connection is kept open and
+    reused between emails. At most 'max_pending' records wait to be sent,
+    further ones are counted in 'dropped'.
+
+    With 'metrics', the send duration of each email is observed and the
+    sent, failed and dropped counts are reported. With 'flight_records',
+    the records of the flight recorder attached to a record are listed
+    below it, see FlightRecorderFilter.
+    """
+
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None, secure=None, timeout=5.0,
+                 batch_window=10.0, rate_limit=6, max_pending=1000, metrics=None, flight_records=False):
+        SMTPHandler.__init__(self, mailhost, fromaddr, toaddrs, subject, credentials, secure, timeout)
+        self.batch_window = batch_window
+        self.rate_limit = rate_limit
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+        self.flight_records = flight_records
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.register('mails_sent_total', lambda: self.sent, 'counter')
+            metrics.register('mail_failures_total', lambda: self.failed, 'counter')
+            metrics.register('mail_dropped_total', lambda: self.dropped, 'counter')
+        self._pending = deque()
+        self._sending = False
+        self._stopped = False
+        # Number of flush calls waiting, which have the queued records sent right away
+        self._flushing = 0
+        self._smtp = None
+        # Token bucket of emails, refilled at 'rate_limit' per minute
+        self._tokens = float(rate_limit)
+        self._last_refill = time.time()
+        self._start()
+        _threaded_handlers.add(self)
+
+    def _start(self):
+        self._mutex = threading.Lock()
+        self._wakeup = threading.Condition(self._mutex)
+        self._idle = threading.Condition(self._mutex)
+        self._thread = threading.Thread(target=self._run, name='autopylogger-mailer')
+        self._thread.daemon = True
+        if not self._stopped:
+            self._thread.start()
+
+    def after_fork(self):
+        """
+        Drop the records queued by the parent, which mails them itself, and the
+        SMTP connection shared with it, then start a new mailer thread. Called
+        in a forked child.
+        """
+        self._pending = deque()
+        self._sending = False
+        self._flushing = 0
+        if self._smtp is not None:
+            # Closed without QUIT, the parent still uses the connection
+            self._smtp.close()
+            self._smtp = None
+        self._start()
+
+    def emit(self, record):
+        """
+        Queue the record for the next digest email.
+        """
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            with self._mutex:
+                if self._stopped:
+                    return
+                if len(self._pending) >= self.max_pending:
+                    self.dropped += 1
+                    return
+                self._pending.append(record)
+                self._wakeup.notify()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _wait_for_token(self):
+        # Called with the mutex held. Returns when an email may be sent, on flush or on close.
+        while not self._stopped and not self._flushing:
+            now = time.time()
+            self._tokens = min(float(self.rate_limit),
+                               self._tokens + (now - self._last_refill) * self.rate_limit / 60.0)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            self._wakeup.wait((1 - self._tokens) * 60.0 / self.rate_limit)
+
+    def _run(self):
+        while True:
+            with self._mutex:
+                while not self._pending and not self._stopped:
+                    self._wakeup.wait()
+                if not self._pending:
+                    break
+                # Let more records join the digest
+                deadline = self._pending[0].created + self.batch_window
+                while not self._stopped and not self._flushing and time.time() < deadline:
+                    self._wakeup.wait(deadline - time.time())
+                self._wait_for_token()
+                records = list(self._pending)
+                self._pending.clear()
+                self._sending = True
+            try:
+                self.send(records)
+            finally:
+                with self._mutex:
+                    self._sending = False
+                    self._idle.notify_all()
+        self._disconnect()
+
+    def digest(self, records):
+        """
+        Build the email body for a list of records. Identical records are
+        listed once, with the number of times they occurred.
+        """
+        groups = {}
+        for record in records:
+            text = self.format(record)
+            flight_records = record.__dict__.get('flight_records')
+            if self.flight_records and flight_records:
+                text = '%s\nRecent records:\n%s' % (
+                    text, '\n'.join(self.format(flight_record).rstrip('\n') for flight_record in flight_records))
+            key = (record.levelno, record.msg, record.exc_text)
+            if key in groups:
+                groups[key][1] += 1
+                groups[key][2] = record
+            else:
+                groups[key] = [text, 1, record]
+        parts = []
+        for text, count, last_record in groups.values():
+            if count > 1:
+                text = '%s\n(Repeated %d times, last at %s)' % (
+                    text, count, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_record.created)))
+            parts.append(text)
+        return ('\n' + '-' * 70 + '\n').join(parts)
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.mailhost, self.mailport or smtplib.SMTP_PORT, timeout=self.timeout)
+        if self.username:
+            if self.secure is not None:
+                smtp.ehlo()
+                smtp.starttls(*self.secure)
+                smtp.ehlo()
+            smtp.login(self.username, self.password)
+        return smtp
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+    def send(self, records):
+        """
+        Send one digest email for the records, reusing the open SMTP connection if it is still alive.
+        """
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        subject = self.getSubject(records[0])
+        if len(records) > 1:
+            subject = '%s (%d records)' % (subject, len(records))
+        msg['Subject'] = subject
+        msg['Date'] = email.utils.localtime()
+        started = time.perf_counter()
+        try:
+            msg.set_content(self.digest(records))
+            for attempt in (1, 2):
+                try:
+                    if self._smtp is None:
+                        self._smtp = self._connect()
+                    self._smtp.send_message(msg)
+                    break
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError):
+                    # The kept connection may have been closed by the server, retry once on a new one
+                    self._disconnect()
+                    if attempt == 2:
+                        raise
+            self.sent += 1
+            if self.metrics is not None:
+                self.metrics.observe('mail_send_seconds', '', time.perf_counter() - started)
+        except Exception:
+            self.failed += 1
+            self._disconnect()
+            self.handleError(records[-1])
+
+    def flush(self):
+        """
+        Send the queued records right away, without waiting for the batch window or the rate limit, and wait
+        until they have been sent.
+        """
+        if threading.current_thread() is self._thread:
+            return
+        with self._mutex:
+            self._flushing += 1
+            self._wakeup.notify_all()
+            try:
+                while (self._pending or self._sending) and self._thread.is_alive():
+                    self._idle.wait(0.1)
+            finally:
+                self._flushing -= 1
+
+    def close(self):
+        """
+        Send the queued records right away, without waiting for the batch window or the rate limit.
+        """
+        _threaded_handlers.discard(self)
+        with self._mutex:
+            self._stopped = True
+            self._wakeup.notify_all()
+        if threading.current_thread() is not self._thread and self._thread.is_alive():
+            # Bounded, so an unreachable mail server cannot hang the exit
+            self._thread.join(self.timeout * 3)
+        SMTPHandler.close(self)
+
+
+class CollectorClientHandler(logging.Handler):
+    """
+    Handler used by worker processes in multi-process mode. Records are
+    serialized on the calling thread and collected into a batch, which is
+    sent to the collector over a Unix socket when it reaches 'batch_size'
+    bytes, after 'flushInterval' seconds, or right away for records of
+    'flushLevel' or above. The collector owns and rotates the log files.
+
+    While the collector cannot be reached, at most 'max_backlog' bytes of
+    records are kept; the oldest records are then dropped and counted.
+    """
+
+    def __init__(self, address, batch_size=64 * 1024, flushInterval=0.2, flushLevel=logging.ERROR,
+                 max_backlog=16 * 1024 * 1024):
+        logging.Handler.__init__(self)
+        self.address = address
+        self.batch_size = batch_size
+        self.flushInterval = flushInterval
+        self.flushLevel = flushLevel
+        self.max_backlog = max_backlog
+        self.lastFlush = time.time()
+        self.dropped = 0
+        self.pid = os.getpid()
+        self._batch = bytearray()
+        self._socket = None
+        _buffer_flusher.register(self)
+        multiprocessing = sys.modules.get('multiprocessing')
+        if multiprocessing is not None:
+            # Processes of multiprocessing exit with os._exit, without atexit and logging.shutdown
+            from multiprocessing import util
+            util.Finalize(self, self.flush, exitpriority=0)
+
+    def serialize(self, record):
+        """
+        Pickle the record with its message merged and its traceback rendered,
+        also as structured frames for StructuredFormatter, the way the
+        collector rebuilds it with logging.makeLogRecord.
+        """
+        return pickle.dumps(self.record_state(record), pickle.HIGHEST_PROTOCOL)
+
+    def record_state(self, record):
+        state = dict(record.__dict__)
+        state['msg'] = record.getMessage()
+        state['args'] = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+            state['exc_text'] = record.exc_text
+            state['exc_frames'] = exception_frames(record.exc_info)
+            state['exc_info'] = None
+        if state.get('flight_records'):
+            # Records of the flight recorder, see FlightRecorderFilter
+            state['flight_records'] = [self.record_state(flight_record) for flight_record in state['flight_records']]
+        return state
+
+    def emit(self, record):
+        try:
+            data = self.serialize(record)
+            self._batch += _FRAME_HEADER.pack(len(data))
+            self._batch += data
+            if len(self._batch) >= self.batch_size or record.levelno >= self.flushLevel:
+                self._send()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _send(self):
+        # Called with the handler lock held
+        if not self._batch:
+            return
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._socket.connect(self.address)
+            self._socket.sendall(self._batch)
+            self._batch.clear()
+        except OSError:
+            # The collector is not reachable, keep the batch for the next attempt
+            self._close_socket()
+            if len(self._batch) > self.max_backlog:
+                self._drop_oldest()
+        self.lastFlush = time.time()
+
+    def _drop_oldest(self):
+        # Whole frames are dropped, so the batch still starts with a frame header
+        excess = len(self._batch) - self.max_backlog
+        offset = 0
+        records = 0
+        while offset < excess:
+            offset += _FRAME_HEADER.size + _FRAME_HEADER.unpack_from(self._batch, offset)[0]
+            records += 1
+        del self._batch[:offset]
+        self.dropped += records
+
+    def _close_socket(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def isDirty(self):
+        return bool(self._batch)
+
+    def discard_buffer(self):
+        """
+        Drop the batch and the connection. Called in a forked child, where
+        they belong to the parent.
+        """
+        self._batch.clear()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def flush(self):
+        with self.lock:
+            self._send()
+
+    def close(self):
+        _buffer_flusher.unregister(self)
+        with self.lock:
+            self._send()
+            self._close_socket()
+        logging.Handler.close(self)
+
+
+class LogCollector(object):
+    """
+    Thread owning the log files in multi-process mode. It listens on a
+    Unix socket, rebuilds the records sent by CollectorClientHandler in
+    the worker processes and passes them to the handlers of 'logger', so
+    the files are written and rotated by this single process.
+
+    The socket file is only accessible to its owner, since the collector
+    unpickles what it receives.
+    """
+
+    def __init__(self, address, logger):
+        self.address = address
+        self.logger = logger
+        self.received = 0
+        self.pid = os.getpid()
+        if os.path.exists(address):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(address)
+            except OSError:
+                # Left behind by a collector which did not exit cleanly
+                os.remove(address)
+            else:
+                raise ArgumentError('A log collector is already listening on %s' % address)
+            finally:
+                probe.close()
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(address)
+        os.chmod(address, stat.S_IRUSR | stat.S_IWUSR)
+        self._server.listen(128)
+        self._server.setblocking(False)
+        self._waker, self._wake = socket.socketpair()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._server, selectors.EVENT_READ)
+        self._selector.register(self._waker, selectors.EVENT_READ)
+        self._buffers = {}
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='autopylogger-collector')
+        self._thread.daemon = True
+        self._thread.start()
+        # Runs before logging.shutdown, so the received records still reach the files
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopped:
+            for key, _ in self._selector.select():
+                if key.fileobj is self._server:
+                    self._accept()
+                elif key.fileobj is self._waker:
+                    self._stopped = True
+                else:
+                    self._receive(key.fileobj)
+        # Read what the workers sent before stopping
+        for connection in list(self._buffers):
+            connection.setblocking(False)
+            while self._receive(connection):
+                pass
+        self._selector.close()
+
+    def _accept(self):
+        try:
+            connection, _ = self._server.accept()
+        except OSError:
+            return
+        connection.setblocking(True)
+        self._buffers[connection] = bytearray()
+        self._selector.register(connection, selectors.EVENT_READ)
+
+    def _receive(self, connection):
+        buffer = self._buffers[connection]
+        try:
+            data = connection.recv(256 * 1024)
+        except BlockingIOError:
+            return False
+        except OSError:
+            data = b''
+        if not data:
+            self._selector.unregister(connection)
+            del self._buffers[connection]
+            connection.close()
+            return False
+        buffer += data
+        offset = 0
+        size = len(buffer)
+        while size - offset >= _FRAME_HEADER.size:
+            length, = _FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + _FRAME_HEADER.size + length
+            if end > size:
+                break
+            try:
+                self.dispatch(pickle.loads(buffer[offset + _FRAME_HEADER.size:end]))
+            except Exception:
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+            offset = end
+        del buffer[:offset]
+        return True
+
+    def dispatch(self, state):
+        """
+        Rebuild a record sent by a worker and pass it to the handlers of the logger.
+        """
+        if state.get('flight_records'):
+            state['flight_records'] = [logging.makeLogRecord(flight_state) for flight_state in state['flight_records']]
+        record = logging.makeLogRecord(state)
+        self.received += 1
+        # The level of the logger decides, not its capture level, see FastLogger
+        if logging.Logger.isEnabledFor(self.logger, record.levelno):
+            self.logger.callHandlers(record)
+
+    def close(self):
+        """
+        Stop listening, after passing on everything the workers already sent.
+        """
+        if os.getpid() != self.pid:
+            # A forked child inherited this object, the socket belongs to the parent
+            return
+        if self._thread.is_alive():
+            self._wake.send(b'x')
+            self._thread.join()
+        self._server.close()
+        self._waker.close()
+        self._wake.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+
+# Running collectors, by socket address
+_collectors = {}
+
+# Process id which set up each logger name with init_logging, so repeated calls return the logger right away
+_configured = {}
 
 
 class MyFilter(object):
@@ -53,6 +2164,387 @@ class MyFilter(object):
         return log_record.levelno <= self.__level
 
 
+class RateLimitFilter(object):
+    """
+    Logger filter which lets at most 'rate' records per second through for
+    each call site (pathname, lineno) or message template, with bursts of
+    up to 'burst' records. Each key has a token bucket in a table of at
+    most 'max_keys' entries, which is emptied when full. The first record
+    let through after some were dropped tells how many.
+    """
+
+    def __init__(self, rate, burst=None, key='callsite', max_keys=4096):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.key = key
+        self.max_keys = max_keys
+        self.suppressed = 0
+        # Key -> [tokens, time of the last refill, records dropped since the last one let through]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.key == 'callsite':
+            key = (record.pathname, record.lineno)
+        else:
+            key = record.msg if isinstance(record.msg, str) else id(type(record.msg))
+        now = record.created
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.clear()
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1.0
+            dropped = bucket[2]
+            bucket[2] = 0
+        if dropped:
+            record.msg = '%s [%d similar records suppressed]' % (record.msg, dropped)
+        return True
+
+
+class SamplingFilter(object):
+    """
+    Logger filter which keeps a sample of the records of some levels.
+    'rates' maps a level to a probability between 0 and 1 of keeping each
+    record, or to an integer N to keep one record in N. Records of other
+    levels are all kept.
+    """
+
+    def __init__(self, rates):
+        self.rates = {get_level(level): rate for level, rate in rates.items()}
+        self._probabilities = {}
+        self._counters = {}
+        for levelno, rate in self.rates.items():
+            if isinstance(rate, int) and not isinstance(rate, bool) and rate >= 1:
+                self._counters[levelno] = (itertools.count(), rate)
+            else:
+                self._probabilities[levelno] = float(rate)
+
+    def filter(self, record):
+        probability = self._probabilities.get(record.levelno)
+        if probability is not None:
+            return random.random() < probability
+        counter = self._counters.get(record.levelno)
+        if counter is not None:
+            # next() on a count is atomic, so no lock is needed
+            return next(counter[0]) % counter[1] == 0
+        return True
+
+
+class RepeatFilter(object):
+    """
+    Logger filter which drops records repeating the previous one (same
+    level and merged message), then logs 'last message repeated N times'
+    once a different record arrives, or every 'interval' seconds while the
+    repeats go on. Messages are compared as text, so arguments whose
+    comparison raises (e.g. numpy arrays) are never compared.
+    """
+
+    def __init__(self, logger, interval=30.0):
+        self.logger = logger
+        self.interval = interval
+        self._last = None
+        self._repeats = 0
+        self._first_repeat = 0.0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            # Left to the handlers to report, such a record is never a repeat
+            message = None
+        with self._lock:
+            last = self._last
+            if (last is not None and message is not None and record.levelno == last[0]
+                    and message == last[1]):
+                if not self._repeats:
+                    self._first_repeat = record.created
+                self._repeats += 1
+                if record.created - self._first_repeat < self.interval:
+                    return False
+                summary = self._summary(last)
+                keep = False
+            else:
+                summary = self._summary(last) if self._repeats else None
+                # Only what the summary needs is kept, not the record with its traceback
+                self._last = (record.levelno, message, record.name, record.pathname, record.lineno,
+                              record.funcName)
+                keep = True
+            self._repeats = 0
+        if summary is not None:
+            # Logger filters are not run again for the summary
+            self.logger.callHandlers(summary)
+        return keep
+
+    def _summary(self, last):
+        levelno, _, name, pathname, lineno, func = last
+        return self.logger.makeRecord(name, levelno, pathname, lineno, 'last message repeated %d times',
+                                      (self._repeats,), None, func)
+
+
+class FlightRecorderFilter(object):
+    """
+    Handler filter which keeps the records below 'level' in memory instead
+    of letting the handlers write them. Each thread has a ring of the last
+    'size' records, allocated once. When a record of 'dump_level' or above
+    passes, the records of the ring of its thread are attached to it as
+    'flight_records', oldest first, and the ring starts over. Only then
+    are they formatted, e.g. by LevelRoutingFileHandler into the DEBUG file.
+
+    One filter is shared by all handlers of a logger (see
+    set_flight_recorder), and a record handled again after the first
+    handler gets the same answer. As a handler filter, it runs after the
+    logger filters and for records propagated from child loggers.
+    """
+
+    def __init__(self, level, size=1000, dump_level=logging.ERROR):
+        self.level = level
+        self.size = size
+        self.dump_level = dump_level
+        self._local = threading.local()
+
+    def _ring(self):
+        try:
+            return self._local.ring
+        except AttributeError:
+            # Records, then the number of records kept since the last dump
+            ring = self._local.ring = [[None] * self.size, 0]
+            return ring
+
+    def filter(self, record):
+        # The handlers of a logger run one after the other on the logging thread
+        last = getattr(self._local, 'last', None)
+        if last is not None and last[0] is record:
+            return last[1]
+        keep = self._filter(record)
+        self._local.last = (record, keep)
+        return keep
+
+    def _filter(self, record):
+        levelno = record.levelno
+        if levelno < self.level:
+            ring = self._ring()
+            ring[0][ring[1] % self.size] = record
+            ring[1] += 1
+            return False
+        if levelno >= self.dump_level:
+            ring = self._ring()
+            records, count = ring
+            if count:
+                position = count % self.size
+                flight_records = records[:count] if count <= self.size else records[position:] + records[:position]
+                ring[1] = 0
+                for flight_record in flight_records:
+                    # Merged now, so later changes to mutable arguments do not show
+                    try:
+                        flight_record.msg = flight_record.getMessage()
+                        flight_record.args = None
+                    except Exception:
+                        pass
+                # Records sent by a worker process already carry those of the worker
+                record.flight_records = flight_records + (record.__dict__.get('flight_records') or [])
+        return True
+
+
+class AsyncQueueHandler(logging.Handler):
+    """
+    Handler which only enqueues records on the calling thread. A dedicated
+    writer thread owns the wrapped handlers and does all the formatting,
+    file I/O, rotation and mailing.
+
+    The queue is bounded. When it is full, 'block' waits for room,
+    'drop_oldest' evicts the oldest queued record and 'drop_newest'
+    discards the incoming one. Discarded records are counted in 'dropped'.
+
+    In a forked child, the records queued by the parent are dropped (the
+    parent writes them) and a new writer thread is started.
+    """
+
+    def __init__(self, handlers, queue_size=10000, queue_policy='block', name=None):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.dropped = 0
+        self._queue = deque()
+        self._in_flight = 0
+        self._stopped = False
+        self._thread_name = 'autopylogger-writer-%s' % (name or id(self))
+        self._start()
+        _threaded_handlers.add(self)
+
+    def _start(self):
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._drained = threading.Condition(self._mutex)
+        self._thread = threading.Thread(target=self._run, name=self._thread_name)
+        self._thread.daemon = True
+        if not self._stopped:
+            self._thread.start()
+
+    def after_fork(self):
+        """
+        Drop the records queued by the parent and start a new writer thread. Called in a forked child.
+        """
+        self._queue = deque()
+        self._in_flight = 0
+        self._start()
+
+    def prepare(self, record):
+        """
+        Merge the message arguments on the calling thread so the record is
+        not affected by later changes to mutable arguments. Formatting is
+        left to the writer thread.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def handle(self, record):
+        # The queue has its own lock, the handler lock is not needed here
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            with self._mutex:
+                if self._stopped:
+                    return
+                if len(self._queue) >= self.queue_size:
+                    if self.queue_policy == 'drop_newest':
+                        self.dropped += 1
+                        return
+                    elif self.queue_policy == 'drop_oldest':
+                        self._queue.popleft()
+                        self.dropped += 1
+                    else:
+                        while len(self._queue) >= self.queue_size and not self._stopped:
+                            self._not_full.wait()
+                        if self._stopped:
+                            return
+                self._queue.append(record)
+                self._not_empty.notify()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        clock = time.perf_counter
+        while True:
+            with self._mutex:
+                while not self._queue and not self._stopped:
+                    self._not_empty.wait()
+                if not self._queue:
+                    break
+                batch = self._queue
+                self._queue = deque()
+                self._in_flight = len(batch)
+                self._not_full.notify_all()
+            yielded = clock()
+            for record in batch:
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                if clock() - yielded >= _WRITER_YIELD_INTERVAL:
+                    time.sleep(0)
+                    yielded = clock()
+            with self._mutex:
+                self._in_flight = 0
+                if not self._queue:
+                    self._drained.notify_all()
+        for handler in self.handlers:
+            handler.flush()
+
+    def qsize(self):
+        """
+
+        :return: Number of records waiting to be written
+        :rtype: int
+
+        """
+        with self._mutex:
+            return len(self._queue) + self._in_flight
+
+    def flush(self):
+        """
+        Wait until every queued record has been written, then flush the wrapped handlers.
+        """
+        if threading.current_thread() is self._thread:
+            return
+        with self._mutex:
+            while (self._queue or self._in_flight) and self._thread.is_alive():
+                self._drained.wait(0.1)
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        """
+        Stop the writer thread after it has drained the queue and close the wrapped handlers.
+        """
+        _threaded_handlers.discard(self)
+        with self._mutex:
+            self._stopped = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+        if threading.current_thread() is not self._thread and self._thread.is_alive():
+            self._thread.join()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+class AsyncLogger(logging.LoggerAdapter):
+    """
+    Logger for asyncio applications, returned by init_async_logging. Logging
+    calls only enqueue the record for the writer thread of the logger, so
+    the event loop never waits for file I/O, rotation or mail servers.
+    aflush() and aclose() wait for the writer from an executor.
+    """
+
+    def __init__(self, logger, extra=None):
+        logging.LoggerAdapter.__init__(self, logger, extra)
+
+    def process(self, msg, kwargs):
+        if self.extra:
+            kwargs['extra'] = dict(self.extra, **(kwargs.get('extra') or {}))
+        return msg, kwargs
+
+    def flush(self):
+        """
+        Wait until every logged record has been written.
+        """
+        for handler in self.logger.handlers:
+            handler.flush()
+
+    def close(self):
+        """
+        Write every logged record, then remove and close the handlers of the logger.
+        """
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    async def aflush(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+
 class ExperimentalFeatureWarning(Warning):
     pass
 
@@ -78,29 +2570,9 @@ def prepare_log_directory(log_name, log_directory):
 
     """
     try:
-        base_logs_path = log_directory
-        if not os.path.exists(base_logs_path):
-            os.mkdir(base_logs_path)
-
-        logs_file_path = os.path.join(base_logs_path, log_name)
-
-        # print("Log Path : %s" % str(logs_file_path))
-
-        if not os.path.exists(logs_file_path):
-            # print("Making directory : %s" % str(logs_file_path))
-            os.mkdir(logs_file_path)
-
-        if not os.path.exists(os.path.join(logs_file_path, 'Error')):
-            os.mkdir(os.path.join(logs_file_path, 'Error'))
-
-        if not os.path.exists(os.path.join(logs_file_path, 'Debug')):
-            os.mkdir(os.path.join(logs_file_path, 'Debug'))
-
-        if not os.path.exists(os.path.join(logs_file_path, 'Info')):
-            os.mkdir(os.path.join(logs_file_path, 'Info'))
-
-        if not os.path.exists(os.path.join(logs_file_path, 'Warning')):
-            os.mkdir(os.path.join(logs_file_path, 'Warning'))
+        logs_file_path = os.path.join(log_directory, log_name)
+        for _, directory, _ in LEVEL_FILES:
+            os.makedirs(os.path.join(logs_file_path, directory), exist_ok=True)
 
         return logs_file_path
 
@@ -230,6 +2702,23 @@ Requirements: logging
     )
 
 
+def get_level(level):
+    """
+
+    Function to convert a log level to its number
+
+    :param level: Log level, either as a name (DEBUG|INFO|WARNING|ERROR|CRITICAL) or as a number
+    :type level: str or int
+    :return: Level number
+    :rtype: int
+
+    """
+    # Checking if log level in 'str' format or 'int' format
+    if isinstance(level, int):
+        return level
+    return getattr(logging, level.upper())
+
+
 def check_params(**kwargs):
     # Checking if mailing is enabled
     if kwargs.get('enable_mailing'):
@@ -239,11 +2728,108 @@ def check_params(**kwargs):
             raise ArgumentError('Invalid MailFrom address argument.')
         if kwargs.get('mailto_addr') in ('', None, ' '):
             raise ArgumentError('Invalid MailTo address argument.')
+        if not isinstance(kwargs.get('mail_batch_window'), (int, float)) or kwargs.get('mail_batch_window') < 0:
+            raise ArgumentError('Invalid mail batch window argument. It should be a non-negative number.')
+        mail_rate_limit = kwargs.get('mail_rate_limit')
+        if not isinstance(mail_rate_limit, int) or isinstance(mail_rate_limit, bool) or mail_rate_limit <= 0:
+            raise ArgumentError('Invalid mail rate limit argument. It should be a positive integer.')
         if kwargs.get('verify_credentials'):
             if not isinstance(kwargs.get('mail_credentials'), tuple):
                 raise ArgumentError('Invalid MailCredentials Format')
             smtplib.SMTP(kwargs.get('mail_host')).login(*kwargs.get('mail_credentials'))
 
+    # Checking async mode queue settings
+    if kwargs.get('async_mode'):
+        queue_size = kwargs.get('queue_size')
+        if not isinstance(queue_size, int) or isinstance(queue_size, bool) or queue_size <= 0:
+            raise ArgumentError('Invalid queue size argument. Queue size should be a positive integer.')
+        if kwargs.get('queue_policy') not in QUEUE_POLICIES:
+            raise ArgumentError('Invalid queue policy argument. Options: %s' % ' | '.join(QUEUE_POLICIES))
+
+    # Checking write buffer settings
+    buffer_size = kwargs.get('buffer_size')
+    if not isinstance(buffer_size, int) or isinstance(buffer_size, bool) or buffer_size < 0:
+        raise ArgumentError('Invalid buffer size argument. Buffer size should be a non-negative integer.')
+    if buffer_size:
+        flush_interval = kwargs.get('flush_interval')
+        if not isinstance(flush_interval, (int, float)) or flush_interval <= 0:
+            raise ArgumentError('Invalid flush interval argument. Flush interval should be a positive number.')
+
+    # Checking rotation engine settings
+    if kwargs.get('rotation_naming') not in (None,) + ROTATION_NAMINGS:
+        raise ArgumentError('Invalid rotation naming argument. Options: None | %s' % ' | '.join(ROTATION_NAMINGS))
+    compression = kwargs.get('compression')
+    if compression is not None:
+        if compression not in COMPRESSIONS:
+            raise ArgumentError('Invalid compression argument. Options: None | %s' % ' | '.join(COMPRESSIONS))
+        if kwargs.get('rotation_naming') is None:
+            raise ArgumentError('Compression of rotated files needs a rotation naming. '
+                                'Options: %s' % ' | '.join(ROTATION_NAMINGS))
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ArgumentError('zstd compression needs the "zstandard" package. pip install zstandard')
+
+    # Checking output format of the level files
+    output_format = kwargs.get('output_format')
+    if output_format not in OUTPUT_FORMATS:
+        raise ArgumentError('Invalid output format argument. Options: %s' % ' | '.join(OUTPUT_FORMATS))
+    if output_format == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            raise ArgumentError('msgpack output format needs the "msgpack" package. pip install msgpack')
+    output_fields = kwargs.get('output_fields')
+    if output_fields is not None:
+        if (not isinstance(output_fields, (list, tuple)) or not output_fields
+                or not all(isinstance(field, str) for field in output_fields)):
+            raise ArgumentError('Invalid output fields argument. It should be a list of record attribute names.')
+
+    # Checking time index settings
+    index_every = kwargs.get('index_every')
+    if not isinstance(index_every, int) or isinstance(index_every, bool) or index_every < 0:
+        raise ArgumentError('Invalid index every argument. It should be a non-negative integer.')
+
+    # Checking filter settings
+    rate_limit = kwargs.get('rate_limit')
+    if rate_limit is not None:
+        if not isinstance(rate_limit, (int, float)) or isinstance(rate_limit, bool) or rate_limit <= 0:
+            raise ArgumentError('Invalid rate limit argument. It should be a positive number.')
+        burst = kwargs.get('rate_limit_burst')
+        if burst is not None and (not isinstance(burst, int) or isinstance(burst, bool) or burst < 1):
+            raise ArgumentError('Invalid rate limit burst argument. It should be a positive integer.')
+        if kwargs.get('rate_limit_key') not in RATE_LIMIT_KEYS:
+            raise ArgumentError('Invalid rate limit key argument. Options: %s' % ' | '.join(RATE_LIMIT_KEYS))
+    sampling = kwargs.get('sampling')
+    if sampling is not None:
+        if not isinstance(sampling, dict):
+            raise ArgumentError('Invalid sampling argument. It should map log levels to sampling rates.')
+        for level, rate in sampling.items():
+            if not isinstance(level, int) and not isinstance(getattr(logging, str(level).upper(), None), int):
+                raise ArgumentError('Invalid sampling level %r. (DEBUG|INFO|WARNING|ERROR|CRITICAL)' % (level,))
+            if (isinstance(rate, bool) or not isinstance(rate, (int, float))
+                    or not (0 <= rate <= 1 or (isinstance(rate, int) and rate >= 1))):
+                raise ArgumentError('Invalid sampling rate %r. It should be a probability between 0 and 1, '
+                                    'or an integer N to keep one record in N.' % (rate,))
+
+    # Checking flight recorder settings
+    flight_recorder = kwargs.get('flight_recorder')
+    if not isinstance(flight_recorder, int) or isinstance(flight_recorder, bool) or flight_recorder < 0:
+        raise ArgumentError('Invalid flight recorder argument. It should be a non-negative integer.')
+
+    # Checking file pool settings
+    max_open_files = kwargs.get('max_open_files')
+    if not isinstance(max_open_files, int) or isinstance(max_open_files, bool) or max_open_files < 0:
+        raise ArgumentError('Invalid max open files argument. It should be a non-negative integer.')
+
+    # Checking multi-process settings
+    if kwargs.get('process_mode') is not None:
+        if kwargs.get('process_mode') not in PROCESS_MODES:
+            raise ArgumentError('Invalid process mode argument. Options: None | %s' % ' | '.join(PROCESS_MODES))
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ArgumentError('Multi-process mode needs Unix sockets, which are not available on this platform.')
+
     if isinstance(kwargs.get('log_level'), int):
         warnings.warn('In versions > 2020.02.x, you should specify log levels in string format, '
                       'like "DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL".\n'
@@ -258,7 +2844,12 @@ def init_logging(log_name='logger', log_directory='logs', log_mode='a', max_byte
                  log_format='[%(asctime)s] -- %(levelname)s - %(filename)s -- %(funcName)s - Line no - %(lineno)d '
                             '-- %(message)s\n', enable_mailing=False, mail_host=None, mailfrom_addr=None,
                  mailto_addr=None, mail_subject='Exception Report', mail_credentials=None, verify_credentials=False, mail_secure=None,
-                 mail_timeout=2.0):
+                 mail_timeout=2.0, async_mode=False, queue_size=10000, queue_policy='block', buffer_size=0,
+                 flush_interval=1.0, flush_level='ERROR', rotation_naming=None, compression=None,
+                 mail_batch_window=10.0, mail_rate_limit=6, process_mode=None, collector_address=None,
+                 output_format='text', output_fields=None, index_every=0, rate_limit=None, rate_limit_burst=None,
+                 rate_limit_key='callsite', sampling=None, collapse_repeats=False, enable_metrics=False,
+                 date_format=None, utc=False, flight_recorder=0, mail_flight_records=False, max_open_files=0):
     """
 
     Function to initialize logging library with log rotation feature enabled.
@@ -310,120 +2901,242 @@ def init_logging(log_name='logger', log_directory='logs', log_mode='a', max_byte
     :type mail_secure: tuple or None
     :param mail_timeout: Max wait time to connect to smtp server.
     :type mail_timeout: float
+    :param async_mode: Flag to write logs from a background thread. Logging calls only enqueue the record.
+    :type async_mode: Boolean
+    :param queue_size: Max number of records waiting in the queue in async mode
+    :type queue_size: int
+    :param queue_policy: What to do when the queue is full. Options: 'block' | 'drop_oldest' | 'drop_newest'
+    :type queue_policy: str
+    :param buffer_size: Size in bytes of the write buffer of each level file. If 0, every record is flushed.
+    :type buffer_size: int
+    :param flush_interval: Max seconds a buffered record waits before being flushed to the file
+    :type flush_interval: float
+    :param flush_level: Records of this level or above are flushed right away. (DEBUG|INFO|WARNING|ERROR|CRITICAL)
+    :type flush_level: str
+    :param rotation_naming: Naming of rotated files. Options: None (<file>.1 ... <file>.N, shifted on every
+        rotation) | 'timestamp' (<file>.<date>-<time>-<microseconds>) | 'sequence' (<file>.<n>, n growing)
+    :type rotation_naming: str or None
+    :param compression: Compression of rotated files, needs a rotation naming. Options: None | 'gzip' | 'zstd'
+    :type compression: str or None
+    :param mail_batch_window: Seconds to wait for more critical records to send them in one email
+    :type mail_batch_window: float
+    :param mail_rate_limit: Max number of emails sent per minute
+    :type mail_rate_limit: int
+    :param process_mode: Role of this process when several processes log to the same files. Options: None |
+        'collector' (writes the files for all processes) | 'worker' (sends its records to the collector)
+    :type process_mode: str or None
+    :param collector_address: Path of the collector Unix socket. By default '.collector.sock' in the log path.
+    :type collector_address: str or None
+    :param output_format: Format of the level log files. Options: 'text' (log_format) | 'jsonl' (one JSON object
+        per line) | 'msgpack' (MessagePack maps). Console and mail always use log_format.
+    :type output_format: str
+    :param output_fields: Record attributes written in 'jsonl' or 'msgpack' format. By default 'created' and the
+        fields of log_format.
+    :type output_fields: list or None
+    :param index_every: Write a time index entry for every this many records, and at least every second, so
+        autopylogger.reader can jump to a time range. If 0, no index is written.
+    :type index_every: int
+    :param rate_limit: Max records per second from each call site (or message template), the others are dropped.
+        If None, no limit.
+    :type rate_limit: float or None
+    :param rate_limit_burst: Records from a call site let through at once before the rate limit applies.
+        By default the rate limit.
+    :type rate_limit_burst: int or None
+    :param rate_limit_key: What the rate limit applies to. Options: 'callsite' (file and line) | 'template' (message)
+    :type rate_limit_key: str
+    :param sampling: Records kept per level, as a probability or as N to keep one in N, e.g. {'DEBUG': 0.01}.
+        Levels not listed are all kept.
+    :type sampling: dict or None
+    :param collapse_repeats: Flag to log a record repeating the previous one only as 'last message repeated N times'
+    :type collapse_repeats: Boolean
+    :param enable_metrics: Flag to count records, bytes, emit and rotation times, mails and queue drops, see get_stats
+    :type enable_metrics: Boolean
+    :param date_format: time.strftime format of %(asctime)s, e.g. '%Y-%m-%dT%H:%M:%S'. By default
+        '2003-07-08 16:49:45,896'.
+    :type date_format: str or None
+    :param utc: Flag to use UTC instead of local time, for %(asctime)s and for time based rotation
+    :type utc: Boolean
+    :param flight_recorder: Number of records below log_level kept in memory per thread. They are written to the
+        DEBUG file only when an ERROR or CRITICAL record is logged. If 0, records below log_level are not kept.
+    :type flight_recorder: int
+    :param mail_flight_records: Flag to list the records of the flight recorder in the critical error emails
+    :type mail_flight_records: Boolean
+    :param max_open_files: Level files kept open at once by all loggers together. Files are then opened with their
+        first record, and the one written to longest ago is closed when the limit is reached. If 0, files stay open.
+    :type max_open_files: int
     :return: Logger object
     :rtype: Logger
 
     """
 
     try:
+        # A logger this process already set up is returned as it is, only its level follows log_level
+        if _configured.get(log_name) == os.getpid():
+            log = logging.getLogger(log_name)
+            if log.handlers:
+                set_level(log, get_level(log_level))
+                return log
+
         # Checking arguments
         check_params(**locals())
 
-        logs_path = prepare_log_directory(log_name=log_name, log_directory=log_directory)
+        # The directories are made when the first file is opened in them, see TrackedFileMixin
+        logs_path = os.path.join(log_directory, log_name)
 
         log = logging.getLogger(log_name)
-        log_formatter = logging.Formatter(log_format)
-
-        # Adding log handler for logging on console
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(log_formatter)
-
-        # Variables for log paths for DEBUG, INFO, WARN, ERROR
-        debug_log_file_name = os.path.join(os.path.join(logs_path, 'Debug'), (log_name + '.debug'))
-        info_log_file_name = os.path.join(os.path.join(logs_path, 'Info'), (log_name + '.info'))
-        warning_log_file_name = os.path.join(os.path.join(logs_path, 'Warning'), (log_name + '.warn'))
-        error_log_file_name = os.path.join(os.path.join(logs_path, 'Error'), (log_name + '.error'))
-
-        if rotation_criteria.lower() in ('timeandsize', 'sizeandtime'):
-            warnings.warn('Using both time and size based rotation is in '
-                          'experimental mode. \nPlease do not use in PROD environment',
-                          category=ExperimentalFeatureWarning)
-            debug_file_handler = SizedTimedRotatingFileHandler(debug_log_file_name, when=rotate_when,
-                                                               interval=rotate_interval, backupCount=backup_count,
-                                                               encoding=encoding, delay=delay, maxBytes=max_bytes)
-            info_file_handler = SizedTimedRotatingFileHandler(info_log_file_name, when=rotate_when,
-                                                              interval=rotate_interval, backupCount=backup_count,
-                                                              encoding=encoding, delay=delay, maxBytes=max_bytes)
-            warning_file_handler = SizedTimedRotatingFileHandler(warning_log_file_name, when=rotate_when,
-                                                                 interval=rotate_interval, backupCount=backup_count,
-                                                                 encoding=encoding, delay=delay, maxBytes=max_bytes)
-            error_file_handler = SizedTimedRotatingFileHandler(error_log_file_name, when=rotate_when,
-                                                               interval=rotate_interval, backupCount=backup_count,
-                                                               encoding=encoding, delay=delay, maxBytes=max_bytes)
-        elif rotation_criteria.lower() == 'time':
-            # Log handlers for time based file rotation
-            debug_file_handler = TimedRotatingFileHandler(debug_log_file_name, when=rotate_when,
-                                                          interval=rotate_interval, backupCount=backup_count,
-                                                          encoding=encoding, delay=delay)
-            info_file_handler = TimedRotatingFileHandler(info_log_file_name, when=rotate_when,
-                                                         interval=rotate_interval, backupCount=backup_count,
-                                                         encoding=encoding, delay=delay)
-            warning_file_handler = TimedRotatingFileHandler(warning_log_file_name, when=rotate_when,
-                                                            interval=rotate_interval, backupCount=backup_count,
-                                                            encoding=encoding, delay=delay)
-            error_file_handler = TimedRotatingFileHandler(error_log_file_name, when=rotate_when,
-                                                          interval=rotate_interval, backupCount=backup_count,
-                                                          encoding=encoding, delay=delay)
-        else:
-            # Log handlers for size based file rotation
-            debug_file_handler = RotatingFileHandler(debug_log_file_name, mode=log_mode, maxBytes=max_bytes,
-                                                     backupCount=backup_count, encoding=encoding, delay=delay)
-            info_file_handler = RotatingFileHandler(info_log_file_name, mode=log_mode, maxBytes=max_bytes,
-                                                    backupCount=backup_count, encoding=encoding, delay=delay)
-            warning_file_handler = RotatingFileHandler(warning_log_file_name, mode=log_mode, maxBytes=max_bytes,
-                                                       backupCount=backup_count, encoding=encoding, delay=delay)
-            error_file_handler = RotatingFileHandler(error_log_file_name, mode=log_mode, maxBytes=max_bytes,
-                                                     backupCount=backup_count, encoding=encoding, delay=delay)
-
-        # Log handler for sending smtp mail
-        smtp_handler = SMTPHandler(mailhost=mail_host, fromaddr=mailfrom_addr, toaddrs=mailto_addr,
-                                   subject=mail_subject, credentials=mail_credentials, secure=mail_secure,
-                                   timeout=mail_timeout)
-        # Setting smtp log handler properties
-        smtp_handler.setFormatter(log_formatter)
-        smtp_handler.setLevel(logging.CRITICAL)
-        smtp_handler.addFilter(MyFilter(logging.CRITICAL))
-
-        # Setting log handler properties
-        debug_file_handler.setFormatter(log_formatter)
-        debug_file_handler.setLevel(logging.DEBUG)
-        debug_file_handler.addFilter(MyFilter(logging.DEBUG))
-
-        info_file_handler.setFormatter(log_formatter)
-        info_file_handler.setLevel(logging.INFO)
-        info_file_handler.addFilter(MyFilter(logging.INFO))
-
-        warning_file_handler.setFormatter(log_formatter)
-        warning_file_handler.setLevel(logging.WARNING)
-        warning_file_handler.addFilter(MyFilter(logging.WARNING))
-
-        error_file_handler.setFormatter(log_formatter)
-        error_file_handler.setLevel(logging.ERROR)
-        error_file_handler.addFilter(MyFilter(logging.ERROR))
+
+        # Record fields used by the log format and, in structured output, by the level files
+        record_fields = format_fields(log_format)
+        if output_format != 'text':
+            if output_fields is None:
+                output_fields = ['created'] + _FORMAT_FIELD.findall(log_format.replace('%%', ''))
+            record_fields = record_fields | frozenset(output_fields)
+        if rate_limit is not None and rate_limit_key == 'callsite':
+            # The rate limit buckets are keyed by the calling line
+            record_fields = record_fields | {'pathname', 'lineno'}
+
+        # Filters dropping records on the logger, before any handler
+        log_filters = []
+        if collapse_repeats:
+            log_filters.append(RepeatFilter(log))
+        if rate_limit is not None:
+            log_filters.append(RateLimitFilter(rate_limit, burst=rate_limit_burst, key=rate_limit_key))
+        if sampling:
+            log_filters.append(SamplingFilter(sampling))
+        # Filter of the handlers, so it only keeps or dumps the records let through by the logger filters
+        recorder = FlightRecorderFilter(get_level(log_level), size=flight_recorder) if flight_recorder else None
+
+        if process_mode is not None and collector_address is None:
+            collector_address = os.path.join(logs_path, '.collector.sock')
+
+        if process_mode == 'worker':
+            # Records are only sent to the collector, which owns the files, console and mailing
+            if not any(isinstance(client, CollectorClientHandler) and client.pid == os.getpid()
+                       for handler in log.handlers for client in getattr(handler, 'handlers', [handler])):
+                # Handlers inherited from a forked parent write to its files, they are dropped without closing
+                for handler in list(log.handlers):
+                    log.removeHandler(handler)
+                client_handler = CollectorClientHandler(collector_address, flushLevel=get_level(flush_level))
+                if async_mode:
+                    # Sending to the collector can wait on the socket, it is left to the writer thread
+                    log.addHandler(AsyncQueueHandler([client_handler], queue_size=queue_size,
+                                                     queue_policy=queue_policy, name=log_name))
+                else:
+                    log.addHandler(client_handler)
+                set_filters(log, log_filters)
+                set_flight_recorder(log, recorder)
+            # The collector formats the records, with the same log format and output fields
+            use_record_fields(log, record_fields)
+            set_level(log, get_level(log_level))
+            _configured[log_name] = os.getpid()
+            return log
+
+        if max_open_files:
+            # The limit is shared by the level files of all loggers
+            _file_pool.max_open = max_open_files
 
         # Adding log handlers to the log object if not already added
         # Checking is performed to prevent any duplicate addition of handlers
         if not len(log.handlers):
 
-            if console_log:
-                log.addHandler(stream_handler)
+            metrics = Metrics(log_name) if enable_metrics else None
 
-            if enable_mailing:
-                log.addHandler(smtp_handler)
+            # One formatter shared by all handlers, so each record is formatted once
+            log_formatter = CachingFormatter(log_format, date_format, utc=utc)
 
-            log.addHandler(debug_file_handler)
-            log.addHandler(info_file_handler)
-            log.addHandler(warning_file_handler)
-            log.addHandler(error_file_handler)
+            handlers = []
+            if console_log:
+                # Adding log handler for logging on console
+                stream_handler = logging.StreamHandler()
+                stream_handler.setFormatter(log_formatter)
+                handlers.append(stream_handler)
 
-        # Checking if log level in 'str' format or 'int' format
-        if isinstance(log_level, int):
-            log.setLevel(log_level)
-        else:
-            log.setLevel(getattr(logging, log_level.upper()))
+            if enable_mailing:
+                # Log handler for sending smtp mail from a background thread
+                smtp_handler = CoalescingSMTPHandler(mailhost=mail_host, fromaddr=mailfrom_addr,
+                                                     toaddrs=mailto_addr, subject=mail_subject,
+                                                     credentials=mail_credentials, secure=mail_secure,
+                                                     timeout=mail_timeout, batch_window=mail_batch_window,
+                                                     rate_limit=mail_rate_limit, metrics=metrics,
+                                                     flight_records=mail_flight_records)
+                # Setting smtp log handler properties
+                smtp_handler.setFormatter(log_formatter)
+                smtp_handler.setLevel(logging.CRITICAL)
+                smtp_handler.addFilter(MyFilter(logging.CRITICAL))
+                handlers.append(smtp_handler)
+
+            # Single handler routing DEBUG, INFO, WARN, ERROR records to their log files
+            # With the file pool, files are only opened once written to
+            file_handler = LevelRoutingFileHandler(logs_path, log_name, rotation_criteria=rotation_criteria,
+                                                   mode=log_mode, maxBytes=max_bytes, backupCount=backup_count,
+                                                   encoding=encoding, delay=delay or bool(_file_pool.max_open),
+                                                   when=rotate_when, interval=rotate_interval, utc=utc,
+                                                   bufferSize=buffer_size, flushInterval=flush_interval,
+                                                   flushLevel=get_level(flush_level), rotationNaming=rotation_naming,
+                                                   compression=compression, binary=output_format == 'msgpack',
+                                                   indexEvery=index_every, metrics=metrics)
+            if output_format == 'text':
+                file_handler.setFormatter(log_formatter)
+            else:
+                file_handler.setFormatter(StructuredFormatter(output_fields, output_format, date_format, utc=utc))
+            handlers.append(file_handler)
+
+            if async_mode:
+                # Only the queue handler sits on the logger, the writer thread owns the rest
+                queue_handler = AsyncQueueHandler(handlers, queue_size=queue_size, queue_policy=queue_policy,
+                                                  name=log_name)
+                if metrics is not None:
+                    metrics.register('queue_depth', queue_handler.qsize)
+                    metrics.register('queue_dropped_total', lambda: queue_handler.dropped, 'counter')
+                log.addHandler(queue_handler)
+            else:
+                for handler in handlers:
+                    log.addHandler(handler)
+
+            set_filters(log, log_filters)
+            set_flight_recorder(log, recorder)
+
+            if metrics is not None:
+                _metrics[log_name] = metrics
+
+            if process_mode == 'collector':
+                os.makedirs(os.path.dirname(collector_address) or '.', exist_ok=True)
+                _collectors[collector_address] = LogCollector(collector_address, log)
+
+        # Skipping the caller lookup and the thread/process fields if the log format does not use them
+        use_record_fields(log, record_fields)
+
+        # With the flight recorder, records below log_level are made and then kept by its filter
+        set_level(log, get_level(log_level))
+
+        _configured[log_name] = os.getpid()
 
         return log
 
     except Exception:
         exception_message = traceback.format_exc()
         raise Exception('Error occurred in setting up logging. Details: %s' % str(exception_message))
+
+
+def init_async_logging(log_name='logger', queue_policy='drop_newest', **kwargs):
+    """
+
+    Function to initialize logging for asyncio applications, with the directories and level files of init_logging
+
+    Records are written from a background thread (async_mode of init_logging), so a logging call never blocks the
+    event loop. By default records are dropped when the queue is full rather than waiting for room.
+    Wait for the records to be written with 'await logger.aflush()', and on shutdown 'await logger.aclose()'.
+
+    If the logger was already set up by init_logging without async_mode, its handlers are kept as they are.
+
+    :param log_name: Name of log
+    :type log_name: str
+    :param queue_policy: What to do when the queue is full. Options: 'drop_newest' | 'drop_oldest' | 'block'
+    :type queue_policy: str
+    :param kwargs: Other arguments of init_logging
+    :return: Logger adapter with aflush() and aclose()
+    :rtype: AsyncLogger
+
+    """
+    kwargs['async_mode'] = True
+    return AsyncLogger(init_logging(log_name=log_name, queue_policy=queue_policy, **kwargs))
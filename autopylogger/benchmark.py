@@ -0,0 +1,612 @@
+"""
+Benchmark suite for the init_logging configurations.
+
+Run all scenarios and save the results as JSON:
+
+    python -m autopylogger.benchmark --output results.json
+
+Compare with saved results and exit with status 1 on a regression:
+
+    python -m autopylogger.benchmark --baseline results.json --tolerance 0.2
+
+Each scenario logs from 1, 8 or 32 threads with a given message size and
+reports records per second and the p50/p99/p999 latency of a logging call.
+
+The loop lag scenarios log from an asyncio task, with init_logging ('sync')
+or init_async_logging ('async'), while another task measures how late the
+event loop wakes it up. Their latencies are those of the event loop. The
+'slow_console' configuration logs to a console read at
+SLOW_CONSOLE_BYTES_PER_SEC, like a slow terminal or log shipper, which
+blocks the writes once the pipe is full.
+
+    python -m autopylogger.benchmark --loop-lag
+
+The formatter scenarios only create and format records with the default
+log format, with logging.Formatter ('logging') and with the CachingFormatter
+shared by the handlers of init_logging ('caching'). Their latencies are
+those of one record, formatted FORMATS_PER_RECORD times.
+
+    python -m autopylogger.benchmark --formatter
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import socketserver
+import inspect
+import logging
+from array import array
+
+from autopylogger.autopylogger import init_logging, init_async_logging, CachingFormatter, _rotation_worker
+
+# Keyword arguments of init_logging for each configuration
+CONFIGURATIONS = {
+    'default': {},
+    'console': {'console_log': True},
+    'time': {'rotation_criteria': 'time'},
+    'timeandsize': {'rotation_criteria': 'timeandsize'},
+    'rotation_heavy': {'max_bytes': 64 * 1024, 'backup_count': 5},
+    'rotation_heavy_named': {'max_bytes': 64 * 1024, 'backup_count': 5, 'rotation_naming': 'sequence'},
+    'async': {'async_mode': True, 'queue_size': 100000},
+    'buffered': {'buffer_size': 64 * 1024},
+    'mailing': {'enable_mailing': True, 'mailfrom_addr': 'bench@localhost', 'mailto_addr': 'bench@localhost',
+                'mail_batch_window': 0.5, 'mail_rate_limit': 60},
+    'slow_console': {'console_log': True},
+}
+
+# Configurations only run when named, as they take seconds per scenario
+SLOW_CONFIGURATIONS = ('slow_console',)
+
+# Rate at which the console of the 'slow_console' configuration is read
+SLOW_CONSOLE_BYTES_PER_SEC = 2 * 1024 * 1024
+
+THREAD_COUNTS = (1, 8, 32)
+
+MESSAGE_SIZES = (32, 256, 4096)
+
+# Every n-th record of the 'mailing' configuration is CRITICAL
+CRITICAL_EVERY = 100
+
+# Configurations of the loop lag scenarios, each run with a 'sync' and an 'async' logger
+LOOP_LAG_CONFIGURATIONS = ('default', 'rotation_heavy', 'mailing', 'slow_console')
+
+# Period of the task measuring the event loop lag, in seconds
+LOOP_LAG_TICK = 0.001
+
+# Records logged by the loop lag producer task before sleeping one tick, like a busy service handling requests
+LOOP_LAG_BURST = 20
+
+# Formatter of each formatter scenario, for a log format
+FORMATTER_CONFIGURATIONS = {
+    'logging': logging.Formatter,
+    'caching': CachingFormatter,
+}
+
+# Format calls per record in the formatter scenarios: console, level file and the size check of 'timeandsize'
+FORMATS_PER_RECORD = 3
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Local SMTP server which accepts every email and only counts them.
+    Listens on 127.0.0.1 on a free port, see 'address'.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _SMTPRequestHandler)
+        self.messages = 0
+        self.connections = 0
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-smtp')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def address(self):
+        return self.server_address[:2]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b'220 localhost fake SMTP\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.wfile.write(b'250 OK\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+def slow_pipe(bytes_per_sec):
+    """
+
+    Function to open a pipe whose read end is drained at a fixed rate by a background thread
+
+    Writes to the pipe block while it is full. Closing the stream stops the thread.
+
+    :param bytes_per_sec: Rate at which the pipe is read
+    :type bytes_per_sec: int
+    :return: Write end of the pipe
+    :rtype: file object
+
+    """
+    read_fd, write_fd = os.pipe()
+
+    def drain():
+        while True:
+            data = os.read(read_fd, 16384)
+            if not data:
+                break
+            time.sleep(len(data) / float(bytes_per_sec))
+        os.close(read_fd)
+
+    thread = threading.Thread(target=drain, name='slow-pipe')
+    thread.daemon = True
+    thread.start()
+    return os.fdopen(write_fd, 'w')
+
+
+def console_stream(configuration):
+    """
+
+    Function to open the stream standing in for sys.stderr in a configuration with a console
+
+    :param configuration: Name of the configuration in CONFIGURATIONS
+    :type configuration: str
+    :return: A slow pipe for 'slow_console', os.devnull otherwise
+    :rtype: file object
+
+    """
+    if configuration == 'slow_console':
+        return slow_pipe(SLOW_CONSOLE_BYTES_PER_SEC)
+    return open(os.devnull, 'w')
+
+
+def percentile(sorted_values, fraction):
+    """
+
+    Function to get a percentile of sorted values
+
+    :param sorted_values: Values in ascending order
+    :type sorted_values: list
+    :param fraction: Percentile as a fraction, e.g. 0.99
+    :type fraction: float
+    :return: Value at the percentile
+    :rtype: float
+
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def close_logger(log):
+    """
+
+    Function to remove and close all handlers of a logger, which writes out everything they still hold
+
+    :param log: Logger object
+    :type log: Logger
+    :return: None
+
+    """
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+    # Compression and pruning of rotated files are part of the cost
+    _rotation_worker.wait()
+
+
+def run_scenario(configuration, threads, message_size, records, directory, smtp_server=None):
+    """
+
+    Function to run one benchmark scenario
+
+    :param configuration: Name of the configuration in CONFIGURATIONS
+    :type configuration: str
+    :param threads: Number of logging threads
+    :type threads: int
+    :param message_size: Size of each message in characters
+    :type message_size: int
+    :param records: Total number of records, split between the threads
+    :type records: int
+    :param directory: Directory for the log files
+    :type directory: str
+    :param smtp_server: Fake SMTP server for the 'mailing' configuration
+    :type smtp_server: FakeSMTPServer
+    :return: Results of the scenario
+    :rtype: dict
+
+    """
+    kwargs = dict(console_log=False, log_level='DEBUG')
+    kwargs.update(CONFIGURATIONS[configuration])
+    if kwargs.get('enable_mailing'):
+        kwargs['mail_host'] = smtp_server.address
+    log_name = 'bench_%s_%d_%d' % (configuration, threads, message_size)
+
+    stderr = sys.stderr
+    console = console_stream(configuration) if kwargs.get('console_log') else None
+    if console is not None:
+        # The console handler binds sys.stderr when it is created
+        sys.stderr = console
+    try:
+        log = init_logging(log_name=log_name, log_directory=directory, **kwargs)
+        message = 'x' * message_size
+        per_thread = records // threads
+        mail_every = CRITICAL_EVERY if kwargs.get('enable_mailing') else 0
+        latencies = [None] * threads
+        barrier = threading.Barrier(threads + 1)
+
+        def worker(index):
+            timings = array('q')
+            clock = time.perf_counter_ns
+            info = log.info
+            critical = log.critical
+            barrier.wait()
+            for i in range(per_thread):
+                start = clock()
+                if mail_every and i % mail_every == 0:
+                    critical(message)
+                else:
+                    info(message)
+                timings.append(clock() - start)
+            latencies[index] = timings
+
+        workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+        for thread in workers:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        calls_done = time.perf_counter()
+        close_logger(log)
+        finished = time.perf_counter()
+    finally:
+        sys.stderr = stderr
+        if console is not None:
+            console.close()
+
+    merged = sorted(value for timings in latencies for value in timings)
+    total = per_thread * threads
+    return {
+        'configuration': configuration,
+        'threads': threads,
+        'message_size': message_size,
+        'records': total,
+        'seconds': finished - started,
+        'records_per_sec': total / (finished - started),
+        'calls_per_sec': total / (calls_done - started),
+        'latency_us': {
+            'p50': percentile(merged, 0.50) / 1000.0,
+            'p99': percentile(merged, 0.99) / 1000.0,
+            'p999': percentile(merged, 0.999) / 1000.0,
+            'max': merged[-1] / 1000.0 if merged else 0.0,
+        },
+    }
+
+
+def run_loop_lag_scenario(configuration, mode, message_size, records, directory, smtp_server=None):
+    """
+
+    Function to measure how long logging from an asyncio task stalls the event loop
+
+    :param configuration: Name of the configuration in CONFIGURATIONS
+    :type configuration: str
+    :param mode: 'sync' for init_logging, 'async' for init_async_logging
+    :type mode: str
+    :param message_size: Size of each message in characters
+    :type message_size: int
+    :param records: Number of records to log
+    :type records: int
+    :param directory: Directory for the log files
+    :type directory: str
+    :param smtp_server: Fake SMTP server for the 'mailing' configuration
+    :type smtp_server: FakeSMTPServer
+    :return: Results of the scenario, with the event loop lag as latency
+    :rtype: dict
+
+    """
+    kwargs = dict(console_log=False, log_level='DEBUG')
+    kwargs.update(CONFIGURATIONS[configuration])
+    if kwargs.get('enable_mailing'):
+        kwargs['mail_host'] = smtp_server.address
+    log_name = 'bench_loop_%s_%s_%d' % (mode, configuration, message_size)
+    stderr = sys.stderr
+    console = console_stream(configuration) if kwargs.get('console_log') else None
+    if console is not None:
+        sys.stderr = console
+    try:
+        if mode == 'async':
+            kwargs.update(async_mode=True, queue_size=max(records, 1))
+            log = init_async_logging(log_name=log_name, log_directory=directory, **kwargs)
+        else:
+            log = init_logging(log_name=log_name, log_directory=directory, **kwargs)
+    finally:
+        sys.stderr = stderr
+    message = 'x' * message_size
+    mail_every = CRITICAL_EVERY if kwargs.get('enable_mailing') else 0
+    lags = array('q')
+
+    async def ticker(done):
+        clock = time.perf_counter_ns
+        tick = int(LOOP_LAG_TICK * 1e9)
+        while not done.is_set():
+            expected = clock() + tick
+            await asyncio.sleep(LOOP_LAG_TICK)
+            lags.append(max(0, clock() - expected))
+
+    async def producer():
+        for i in range(records):
+            if mail_every and i % mail_every == 0:
+                log.critical(message)
+            else:
+                log.info(message)
+            if i % LOOP_LAG_BURST == LOOP_LAG_BURST - 1:
+                await asyncio.sleep(LOOP_LAG_TICK)
+
+    async def scenario():
+        done = asyncio.Event()
+        ticker_task = asyncio.ensure_future(ticker(done))
+        await asyncio.sleep(LOOP_LAG_TICK * 2)
+        started = time.perf_counter()
+        await producer()
+        calls_done = time.perf_counter()
+        done.set()
+        await ticker_task
+        if mode == 'async':
+            await log.aclose()
+        else:
+            close_logger(log)
+        _rotation_worker.wait()
+        return started, calls_done, time.perf_counter()
+
+    try:
+        started, calls_done, finished = asyncio.run(scenario())
+    finally:
+        if console is not None:
+            console.close()
+    lags = sorted(lags)
+    return {
+        'configuration': 'loop_lag_%s_%s' % (mode, configuration),
+        'threads': 1,
+        'message_size': message_size,
+        'records': records,
+        'seconds': finished - started,
+        'records_per_sec': records / (finished - started),
+        'calls_per_sec': records / (calls_done - started),
+        'latency_us': {
+            'p50': percentile(lags, 0.50) / 1000.0,
+            'p99': percentile(lags, 0.99) / 1000.0,
+            'p999': percentile(lags, 0.999) / 1000.0,
+            'max': lags[-1] / 1000.0 if lags else 0.0,
+        },
+    }
+
+
+def run_formatter_scenario(configuration, message_size, records):
+    """
+
+    Function to measure the cost of creating and formatting a record, without any handler
+
+    :param configuration: Name of the formatter in FORMATTER_CONFIGURATIONS
+    :type configuration: str
+    :param message_size: Size of each message in characters
+    :type message_size: int
+    :param records: Number of records
+    :type records: int
+    :return: Results of the scenario, with the time of one record as latency
+    :rtype: dict
+
+    """
+    log_format = inspect.signature(init_logging).parameters['log_format'].default
+    formatter = FORMATTER_CONFIGURATIONS[configuration](log_format)
+    message = 'x' * message_size + ' %d'
+    timings = array('q')
+    clock = time.perf_counter_ns
+    make_record = logging.LogRecord
+    format_record = formatter.format
+    started = time.perf_counter()
+    for i in range(records):
+        start = clock()
+        record = make_record('bench', logging.INFO, __file__, 1, message, (i,), None, 'run_formatter_scenario')
+        for _ in range(FORMATS_PER_RECORD):
+            format_record(record)
+        timings.append(clock() - start)
+    finished = time.perf_counter()
+    timings = sorted(timings)
+    return {
+        'configuration': 'formatter_%s' % configuration,
+        'threads': 1,
+        'message_size': message_size,
+        'records': records,
+        'seconds': finished - started,
+        'records_per_sec': records / (finished - started),
+        'calls_per_sec': records / (finished - started),
+        'latency_us': {
+            'p50': percentile(timings, 0.50) / 1000.0,
+            'p99': percentile(timings, 0.99) / 1000.0,
+            'p999': percentile(timings, 0.999) / 1000.0,
+            'max': timings[-1] / 1000.0 if timings else 0.0,
+        },
+    }
+
+
+def scenario_key(result):
+    return '%s/%dt/%db' % (result['configuration'], result['threads'], result['message_size'])
+
+
+def run_benchmarks(configurations=None, thread_counts=THREAD_COUNTS, message_sizes=MESSAGE_SIZES, records=20000,
+                   verbose=True, loop_lag=False, formatter=False):
+    """
+
+    Function to run the benchmark scenarios
+
+    :param configurations: Names of the configurations to run, all but SLOW_CONFIGURATIONS if None
+    :type configurations: list
+    :param thread_counts: Numbers of logging threads
+    :type thread_counts: tuple
+    :param message_sizes: Message sizes in characters
+    :type message_sizes: tuple
+    :param records: Number of records per scenario
+    :type records: int
+    :param verbose: Flag to print each result as it completes
+    :type verbose: Boolean
+    :param loop_lag: Flag to run the loop lag scenarios instead, for the LOOP_LAG_CONFIGURATIONS among configurations
+    :type loop_lag: Boolean
+    :param formatter: Flag to run the formatter scenarios instead, configurations being FORMATTER_CONFIGURATIONS
+    :type formatter: Boolean
+    :return: Results, with the environment they were measured in
+    :rtype: dict
+
+    """
+    if formatter:
+        configurations = configurations or list(FORMATTER_CONFIGURATIONS)
+    elif loop_lag:
+        configurations = configurations or list(LOOP_LAG_CONFIGURATIONS)
+    else:
+        configurations = configurations or [configuration for configuration in CONFIGURATIONS
+                                            if configuration not in SLOW_CONFIGURATIONS]
+    smtp_server = FakeSMTPServer() if 'mailing' in configurations and not formatter else None
+    directory = tempfile.mkdtemp(prefix='autopylogger-bench-')
+    results = {}
+    if formatter:
+        scenarios = [(run_formatter_scenario, (configuration, message_size, records))
+                     for configuration in configurations for message_size in message_sizes]
+    elif loop_lag:
+        scenarios = [(run_loop_lag_scenario, (configuration, mode, message_size, records, directory, smtp_server))
+                     for configuration in configurations for mode in ('sync', 'async')
+                     for message_size in message_sizes]
+    else:
+        scenarios = [(run_scenario, (configuration, threads, message_size, records, directory, smtp_server))
+                     for configuration in configurations for threads in thread_counts
+                     for message_size in message_sizes]
+    try:
+        for scenario, arguments in scenarios:
+            result = scenario(*arguments)
+            results[scenario_key(result)] = result
+            if verbose:
+                print('%-40s %10.0f rec/s   p50 %8.1f us   p99 %8.1f us   p999 %8.1f us' % (
+                    scenario_key(result), result['records_per_sec'], result['latency_us']['p50'],
+                    result['latency_us']['p99'], result['latency_us']['p999']))
+    finally:
+        if smtp_server is not None:
+            smtp_server.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+
+    Function to find the scenarios which got slower than the baseline
+
+    A scenario regresses when its records per second drop, or its p99 latency grows,
+    by more than the tolerance. Scenarios missing from either side are ignored.
+
+    :param results: Results of run_benchmarks
+    :type results: dict
+    :param baseline: Earlier results of run_benchmarks
+    :type baseline: dict
+    :param tolerance: Allowed change as a fraction, e.g. 0.2 for 20%
+    :type tolerance: float
+    :return: Description of each regression
+    :rtype: list
+
+    """
+    regressions = []
+    for key, result in sorted(results['results'].items()):
+        previous = baseline['results'].get(key)
+        if previous is None:
+            continue
+        if result['records_per_sec'] < previous['records_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.0f rec/s, baseline %.0f rec/s' % (
+                key, result['records_per_sec'], previous['records_per_sec']))
+        if result['latency_us']['p99'] > previous['latency_us']['p99'] * (1 + tolerance):
+            regressions.append('%s: p99 %.1f us, baseline %.1f us' % (
+                key, result['latency_us']['p99'], previous['latency_us']['p99']))
+    return regressions
+
+
+def _int_list(value):
+    return tuple(int(item) for item in value.split(','))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m autopylogger.benchmark',
+                                     description='Benchmark the autopylogger configurations.')
+    parser.add_argument('--configurations', type=lambda value: value.split(','), default=None,
+                        help='Comma separated configurations. Options: %s' % ', '.join(CONFIGURATIONS))
+    parser.add_argument('--threads', type=_int_list, default=THREAD_COUNTS,
+                        help='Comma separated numbers of logging threads (default: 1,8,32)')
+    parser.add_argument('--sizes', type=_int_list, default=MESSAGE_SIZES,
+                        help='Comma separated message sizes (default: 32,256,4096)')
+    parser.add_argument('--records', type=int, default=20000, help='Records per scenario (default: 20000)')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline as a fraction (default: 0.2)')
+    parser.add_argument('--loop-lag', action='store_true',
+                        help='Measure the event loop lag of logging from asyncio, with init_logging and '
+                             'init_async_logging (default configurations: %s)' % ', '.join(LOOP_LAG_CONFIGURATIONS))
+    parser.add_argument('--formatter', action='store_true',
+                        help='Measure creating and formatting records only, with logging.Formatter and '
+                             'CachingFormatter (configurations: %s)' % ', '.join(FORMATTER_CONFIGURATIONS))
+    args = parser.parse_args(argv)
+
+    unknown = set(args.configurations or ()) - set(FORMATTER_CONFIGURATIONS if args.formatter else CONFIGURATIONS)
+    if unknown:
+        parser.error('Unknown configurations: %s' % ', '.join(sorted(unknown)))
+
+    results = run_benchmarks(args.configurations, args.threads, args.sizes, args.records, loop_lag=args.loop_lag,
+                             formatter=args.formatter)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        if regressions:
+            return 1
+        print('No regression against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
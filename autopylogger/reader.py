@@ -0,0 +1,446 @@
+"""
+Reader for the level log files written by init_logging.
+
+Records are read from the current file and every backup of the chosen
+levels and merged into one stream ordered by creation time:
+
+    from autopylogger.reader import query
+
+    for entry in query('logs', 'my_logs', since=time.time() - 3600, levels=['ERROR']):
+        print(entry.created, entry.level, entry.record)
+
+Plain files are memory-mapped, and with a time index (see 'index_every'
+of init_logging) only the part of each file in the time range is read.
+Without an index, or for compressed backups, files are read from the
+start. Records are never loaded a whole file at a time.
+"""
+import os
+import re
+import json
+import calendar
+import gzip
+import mmap
+import time
+import math
+import heapq
+import bisect
+import logging
+from collections import namedtuple
+from operator import attrgetter
+
+from autopylogger.autopylogger import LEVEL_FILES, COMPRESSIONS, INDEX_ENTRY, index_filename, get_level
+
+# A record read from a log file. 'record' is the text of the record, or a dict for 'jsonl' and 'msgpack' files.
+LogEntry = namedtuple('LogEntry', ('created', 'level', 'path', 'record'))
+
+# Records of several threads reach the file slightly out of creation order, so index lookups leave this margin
+INDEX_SLACK = 1.0
+
+# Date and time written by %(asctime)s with the default date format, e.g. '2020-01-31 23:59:59,123'
+_TEXT_TIMESTAMP = re.compile(rb'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3})')
+
+_DEFAULT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Patterns of the time.strftime directives, for date formats given with 'date_format'
+_DIRECTIVE_PATTERNS = {'Y': r'\d{4}', 'y': r'\d{2}', 'm': r'\d{2}', 'd': r'\d{2}', 'H': r'\d{2}', 'I': r'\d{2}',
+                       'M': r'\d{2}', 'S': r'\d{2}', 'j': r'\d{3}', 'U': r'\d{2}', 'W': r'\d{2}', 'w': r'\d',
+                       'a': r'[^\W\d_]+', 'A': r'[^\W\d_]+', 'b': r'[^\W\d_]+', 'B': r'[^\W\d_]+', 'p': r'\w+',
+                       'z': r'[+-]\d{4}', 'Z': r'\w+', '%': '%'}
+
+# A record starts with a line having a timestamp within its first bytes, other lines continue it
+_TIMESTAMP_SEARCH_BYTES = 64
+
+_CHUNK_SIZE = 64 * 1024
+
+# Numbers in the suffix of a backup, compared as numbers when sorting the backups
+_DIGITS = re.compile(r'(\d+)')
+
+
+def _backup_age_key(suffix, rotation_naming):
+    # Sorts the backups oldest first. '<file>.1' is the newest backup with the default naming, the oldest with
+    # 'sequence'; time suffixes, with the counter of 'timeandsize', grow with the time.
+    for extension in COMPRESSIONS.values():
+        if suffix.endswith(extension):
+            suffix = suffix[:-len(extension)]
+            break
+    if suffix.isdigit():
+        return (-int(suffix) if rotation_naming is None else int(suffix),)
+    return tuple(int(part) if part.isdigit() else part for part in _DIGITS.split(suffix))
+
+
+def level_files(log_directory, log_name, levels=None, rotation_naming=None):
+    """
+
+    Function to list the log files of each level, the current file and all its backups
+
+    :param log_directory: Directory passed to init_logging
+    :type log_directory: str
+    :param log_name: Name of log passed to init_logging
+    :type log_name: str
+    :param levels: Levels to read (DEBUG|INFO|WARNING|ERROR), all if None
+    :type levels: list or None
+    :param rotation_naming: 'rotation_naming' passed to init_logging
+    :type rotation_naming: str or None
+    :return: Level name and path of each file, the backups of a level oldest first and then its current file
+    :rtype: list
+
+    """
+    levelnos = None if levels is None else {get_level(level) for level in levels}
+    files = []
+    for levelno, directory, extension in LEVEL_FILES:
+        if levelnos is not None and levelno not in levelnos:
+            continue
+        level_directory = os.path.join(log_directory, log_name, directory)
+        base_name = log_name + extension
+        prefix = base_name + '.'
+        try:
+            file_names = os.listdir(level_directory)
+        except FileNotFoundError:
+            continue
+        backups = sorted((file_name for file_name in file_names
+                          if file_name.startswith(prefix) and not file_name.endswith('.tmp')),
+                         key=lambda file_name: _backup_age_key(file_name[len(prefix):], rotation_naming))
+        if base_name in file_names:
+            backups.append(base_name)
+        files.extend((logging.getLevelName(levelno), os.path.join(level_directory, file_name))
+                     for file_name in backups)
+    return files
+
+
+def read_index(filename):
+    """
+
+    Function to read the time index of a log file
+
+    :param filename: Path of the log file
+    :type filename: str
+    :return: Creation times and offsets of the indexed records, times never decreasing
+    :rtype: tuple
+
+    """
+    try:
+        with open(index_filename(filename), 'rb') as index_file:
+            data = index_file.read()
+    except FileNotFoundError:
+        return [], []
+    # A crash can leave a partly written last entry
+    data = memoryview(data)[:len(data) - len(data) % INDEX_ENTRY.size]
+    times = []
+    offsets = []
+    latest = float('-inf')
+    for created, offset in INDEX_ENTRY.iter_unpack(data):
+        latest = max(latest, created)
+        times.append(latest)
+        offsets.append(offset)
+    return times, offsets
+
+
+def timestamp_pattern(date_format=None):
+    """
+
+    Function to build the pattern of the %(asctime)s of text log files
+
+    :param date_format: 'date_format' passed to init_logging, None for the default date format
+    :type date_format: str or None
+    :return: Pattern on bytes. Group 1 is the date and time, group 2 the milliseconds, empty if not written.
+    :rtype: re.Pattern
+
+    """
+    if date_format is None:
+        return _TEXT_TIMESTAMP
+    parts = []
+    position = 0
+    for match in re.finditer(r'%(.)', date_format):
+        parts.append(re.escape(date_format[position:match.start()]))
+        directive = match.group(1)
+        if directive not in _DIRECTIVE_PATTERNS:
+            raise ValueError('Unsupported directive %%%s in date format %r' % (directive, date_format))
+        parts.append(_DIRECTIVE_PATTERNS[directive])
+        position = match.end()
+    parts.append(re.escape(date_format[position:]))
+    # With a date format, logging writes no milliseconds
+    return re.compile(('(%s)()' % ''.join(parts)).encode('ascii'))
+
+
+def detect_format(head):
+    """
+
+    Function to tell the output format of a log file from its first bytes
+
+    :param head: First bytes of the file
+    :type head: bytes
+    :return: 'text' | 'jsonl' | 'msgpack'
+    :rtype: str
+
+    """
+    if head[:1] == b'{':
+        return 'jsonl'
+    # MessagePack maps start with a fixmap (0x80-0x8f), map16 (0xde) or map32 (0xdf) marker
+    if head and (0x80 <= head[0] <= 0x8f or head[0] in (0xde, 0xdf)):
+        return 'msgpack'
+    return 'text'
+
+
+class _LogFile(object):
+    """
+    Bytes of a log file: memory-mapped for a plain file, or a decompressing
+    stream for a compressed backup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mmap = None
+        self.stream = None
+        if path.endswith(COMPRESSIONS['gzip']) or path.endswith(COMPRESSIONS['zstd']):
+            self.stream = self._open_stream()
+        else:
+            with open(path, 'rb') as log_file:
+                if os.fstat(log_file.fileno()).st_size:
+                    self.mmap = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _open_stream(self):
+        if self.path.endswith(COMPRESSIONS['gzip']):
+            return gzip.open(self.path, 'rb')
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(self.path, 'rb'), closefd=True)
+
+    def _seek(self, position):
+        # A zstd stream only seeks forwards, so it is reopened to go back
+        if self.stream.tell() > position and self.path.endswith(COMPRESSIONS['zstd']):
+            self.stream.close()
+            self.stream = self._open_stream()
+        self.stream.seek(position)
+
+    def head(self, size=16):
+        if self.mmap is not None:
+            return self.mmap[:size]
+        if self.stream is not None:
+            data = self.stream.read(size)
+            self._seek(0)
+            return data
+        return b''
+
+    def lines(self, start, end):
+        """
+        Offset and bytes of each line from 'start' up to 'end'.
+        """
+        if self.mmap is not None:
+            data = self.mmap
+            end = min(end, len(data))
+            position = start
+            while position < end:
+                line_end = data.find(b'\n', position)
+                line_end = len(data) if line_end < 0 else line_end + 1
+                yield position, data[position:line_end]
+                position = line_end
+        elif self.stream is not None:
+            self._seek(start)
+            position = start
+            while position < end:
+                line = self.stream.readline()
+                if not line:
+                    break
+                yield position, line
+                position += len(line)
+
+    def chunks(self, start, end):
+        """
+        Bytes from 'start' up to 'end', in chunks.
+        """
+        if self.mmap is not None:
+            end = min(end, len(self.mmap))
+            for position in range(start, end, _CHUNK_SIZE):
+                yield self.mmap[position:min(position + _CHUNK_SIZE, end)]
+        elif self.stream is not None:
+            self._seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = self.stream.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+        if self.stream is not None:
+            self.stream.close()
+
+
+def _parse_timestamp(text, utc, date_format=_DEFAULT_DATE_FORMAT, cache={}):
+    # Seconds are parsed once, records of the same second only add their milliseconds
+    seconds = cache.get((text, utc, date_format))
+    if seconds is None:
+        if len(cache) > 1024:
+            cache.clear()
+        time_tuple = time.strptime(text.decode(), date_format)
+        seconds = cache[(text, utc, date_format)] = calendar.timegm(time_tuple) if utc else time.mktime(time_tuple)
+    return seconds
+
+
+def _text_records(lines, created, encoding, utc, date_format=None):
+    # Records without a timestamp of their own get the time of the record or index entry before them
+    pattern = timestamp_pattern(date_format)
+    date_format = date_format or _DEFAULT_DATE_FORMAT
+    record = None
+    for _, line in lines:
+        match = pattern.search(line, 0, _TIMESTAMP_SEARCH_BYTES)
+        if match is not None:
+            if record is not None:
+                yield created, b''.join(record).decode(encoding, 'replace').rstrip()
+            milliseconds = match.group(2)
+            created = _parse_timestamp(match.group(1), utc, date_format)
+            if milliseconds:
+                created += int(milliseconds) / 1000.0
+            record = [line]
+        elif record is None:
+            if line.strip():
+                record = [line]
+        else:
+            record.append(line)
+    if record is not None:
+        yield created, b''.join(record).decode(encoding, 'replace').rstrip()
+
+
+def _text_since(since, date_format):
+    # Text timestamps are cut to milliseconds, or to seconds for a custom date format, so 'since'
+    # is cut the same way to keep the records logged in its first millisecond or second
+    seconds = math.floor(since)
+    if date_format:
+        return float(seconds)
+    return seconds + int((since - seconds) * 1000 + 1e-6) / 1000.0
+
+
+def _jsonl_records(lines, created, pattern):
+    for _, line in lines:
+        # The pattern is matched on the raw line, so lines left out are not decoded
+        if pattern is not None and pattern.search(line.decode('utf-8', 'replace')) is None:
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        created = record.get('created', created)
+        yield created, record
+
+
+def _msgpack_records(chunks, created):
+    import msgpack
+    unpacker = msgpack.Unpacker(raw=False)
+    for chunk in chunks:
+        unpacker.feed(chunk)
+        for record in unpacker:
+            if isinstance(record, dict):
+                created = record.get('created', created)
+                yield created, record
+
+
+def read_file(path, level, since=None, until=None, grep=None, encoding='utf-8', utc=False, date_format=None):
+    """
+
+    Function to read the records of one log file within a time range
+
+    :param path: Path of the log file
+    :type path: str
+    :param level: Level name given to the records
+    :type level: str
+    :param since: Earliest creation time, as seconds since the epoch
+    :type since: float or None
+    :param until: Latest creation time, as seconds since the epoch
+    :type until: float or None
+    :param grep: Regular expression the record must contain
+    :type grep: str or None
+    :param encoding: Encoding of text log files
+    :type encoding: str
+    :param utc: Flag for text log files written with utc, so their times are in UTC
+    :type utc: Boolean
+    :param date_format: 'date_format' the text log files were written with, None for the default
+    :type date_format: str or None
+    :return: Records of the file, in the order they were written
+    :rtype: iterator of LogEntry
+
+    """
+    pattern = re.compile(grep) if grep else None
+    times, offsets = read_index(path)
+    if until is not None and times and times[0] > until + INDEX_SLACK:
+        return
+
+    start = 0
+    created = times[0] if times else 0.0
+    if since is not None and times:
+        position = bisect.bisect_left(times, since - INDEX_SLACK) - 1
+        if position >= 0:
+            start = offsets[position]
+            created = times[position]
+    end = float('inf')
+    if until is not None and times:
+        position = bisect.bisect_right(times, until + INDEX_SLACK)
+        if position < len(times):
+            end = offsets[position]
+
+    log_file = _LogFile(path)
+    try:
+        output_format = detect_format(log_file.head())
+        if output_format == 'msgpack':
+            records = _msgpack_records(log_file.chunks(start, end), created)
+        elif output_format == 'jsonl':
+            records = _jsonl_records(log_file.lines(start, end), created, pattern)
+        else:
+            records = _text_records(log_file.lines(start, end), created, encoding, utc, date_format)
+            if since is not None:
+                since = _text_since(since, date_format)
+
+        for created, record in records:
+            if since is not None and created < since:
+                continue
+            if until is not None and created > until:
+                continue
+            if pattern is not None and output_format != 'jsonl':
+                text = record if output_format == 'text' else json.dumps(record, default=str)
+                if pattern.search(text) is None:
+                    continue
+            yield LogEntry(created, level, path, record)
+    finally:
+        log_file.close()
+
+
+def query(log_directory, log_name, since=None, until=None, levels=None, grep=None, encoding='utf-8', utc=False,
+          date_format=None, rotation_naming=None):
+    """
+
+    Function to read the records of all level files and backups, merged in creation time order
+
+    :param log_directory: Directory passed to init_logging
+    :type log_directory: str
+    :param log_name: Name of log passed to init_logging
+    :type log_name: str
+    :param since: Earliest creation time, as seconds since the epoch
+    :type since: float or None
+    :param until: Latest creation time, as seconds since the epoch
+    :type until: float or None
+    :param levels: Levels to read (DEBUG|INFO|WARNING|ERROR), all if None
+    :type levels: list or None
+    :param grep: Regular expression the records must contain
+    :type grep: str or None
+    :param encoding: Encoding of text log files
+    :type encoding: str
+    :param utc: Flag for text log files written with utc, so their times are in UTC
+    :type utc: Boolean
+    :param date_format: 'date_format' the text log files were written with, None for the default
+    :type date_format: str or None
+    :param rotation_naming: 'rotation_naming' passed to init_logging, which tells the order of the backups
+    :type rotation_naming: str or None
+    :return: Records in creation time order. Records logged by concurrent threads at nearly the same time
+        keep the order in which they were written.
+    :rtype: iterator of LogEntry
+
+    """
+    # An unsupported date format raises ValueError here, rather than once the records are read
+    timestamp_pattern(date_format)
+    streams = [read_file(path, level, since, until, grep, encoding, utc, date_format)
+               for level, path in level_files(log_directory, log_name, levels, rotation_naming)]
+    return heapq.merge(*streams, key=attrgetter('created'))
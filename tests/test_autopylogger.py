@@ -0,0 +1,181 @@
+import io
+import os
+import json
+import time
+import inspect
+import logging
+
+import pytest
+
+from autopylogger import init_logging, use_record_fields
+from autopylogger.autopylogger import CoalescingSMTPHandler, _rotation_worker
+from autopylogger.benchmark import FakeSMTPServer
+from autopylogger.reader import query
+
+fork_only = pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+
+
+@pytest.fixture
+def log_name(request):
+    # Loggers are global, each test gets its own and closes its handlers
+    name = 'test_%s' % request.node.name.replace('[', '_').strip(']')
+    yield name
+    log = logging.getLogger(name)
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+
+
+def read_level_file(directory, log_name, folder, extension):
+    with open(os.path.join(str(directory), log_name, folder, log_name + extension)) as log_file:
+        return log_file.read()
+
+
+def run_in_child(function):
+    # Runs function in a forked child and returns its exit status, 0 when it returned True
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            status = 0 if function() else 1
+        finally:
+            os._exit(status)
+    return os.waitpid(pid, 0)[1]
+
+
+@fork_only
+def test_async_writer_runs_in_forked_child(tmp_path, log_name):
+    log = init_logging(log_name, log_directory=str(tmp_path), console_log=False, async_mode=True, queue_size=100)
+    log.info('record of the parent')
+
+    def child():
+        for i in range(300):
+            log.info('record of the child %d', i)
+        logging.shutdown()
+        return True
+
+    assert run_in_child(child) == 0
+    logging.shutdown()
+    text = read_level_file(tmp_path, log_name, 'Info', '.info')
+    assert text.count('record of the parent') == 1
+    assert text.count('record of the child') == 300
+
+
+@fork_only
+def test_buffer_flusher_runs_in_forked_child(tmp_path, log_name):
+    log = init_logging(log_name, log_directory=str(tmp_path), console_log=False, buffer_size=64 * 1024,
+                       flush_interval=0.1)
+    log.info('record of the parent')
+
+    def child():
+        log.info('record of the child')
+        time.sleep(1)
+        # Written by the flusher thread of the child, without a flush call
+        text = read_level_file(tmp_path, log_name, 'Info', '.info')
+        return text.count('record of the child') == 1
+
+    assert run_in_child(child) == 0
+    logging.shutdown()
+    # The buffer inherited by the child was dropped, not written a second time
+    text = read_level_file(tmp_path, log_name, 'Info', '.info')
+    assert text.count('record of the parent') == 1
+    assert text.count('record of the child') == 1
+
+
+@fork_only
+def test_mailer_runs_in_forked_child(tmp_path, log_name):
+    server = FakeSMTPServer()
+    try:
+        log = init_logging(log_name, log_directory=str(tmp_path), console_log=False, enable_mailing=True,
+                           mail_host=server.address, mailfrom_addr='from@localhost', mailto_addr='to@localhost',
+                           mail_batch_window=0.1)
+        mailer = [handler for handler in log.handlers if isinstance(handler, CoalescingSMTPHandler)][0]
+        log.critical('parent')
+        mailer.flush()
+        assert mailer.sent == 1
+
+        def child():
+            log.critical('child')
+            mailer.flush()
+            return mailer.sent == 2 and mailer._thread.is_alive()
+
+        assert run_in_child(child) == 0
+        assert server.messages == 2
+    finally:
+        server.close()
+
+
+def test_record_fields_include_ancestor_handlers(log_name):
+    parent = logging.getLogger(log_name)
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(lineno)d %(message)s'))
+    parent.addHandler(handler)
+    child = logging.getLogger(log_name + '.child')
+    use_record_fields(child, frozenset(['message']))
+    line = inspect.currentframe().f_lineno + 1
+    child.warning('from the child')
+    assert stream.getvalue() == '%d from the child\n' % line
+
+
+def test_record_fields_with_ancestor_brace_format(log_name):
+    parent = logging.getLogger(log_name)
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('{funcName} {message}', style='{'))
+    parent.addHandler(handler)
+    child = logging.getLogger(log_name + '.child')
+    # The fields of a '{' style format cannot be told, so all of them are computed
+    use_record_fields(child, frozenset(['message']))
+    child.warning('from the child')
+    assert stream.getvalue() == 'test_record_fields_with_ancestor_brace_format from the child\n'
+
+
+def test_jsonl_extra(tmp_path, log_name):
+    log = init_logging(log_name, log_directory=str(tmp_path), console_log=False, output_format='jsonl')
+    log.info('first', extra={'request_id': 7})
+    log.info('second')
+    for handler in log.handlers:
+        handler.flush()
+    first, second = [json.loads(line) for line in read_level_file(tmp_path, log_name, 'Info', '.info').splitlines()]
+    assert first['message'] == 'first'
+    assert first['extra'] == {'request_id': 7}
+    assert second['message'] == 'second'
+    assert 'extra' not in second
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_reader_round_trip_of_compressed_backups(tmp_path, log_name, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    log = init_logging(log_name, log_directory=str(tmp_path), console_log=False, max_bytes=4096, backup_count=100,
+                       rotation_naming='sequence', compression=compression)
+    for i in range(500):
+        log.info('record %d', i)
+    for handler in list(log.handlers):
+        log.removeHandler(handler)
+        handler.close()
+    _rotation_worker.wait()
+    backups = os.listdir(os.path.join(str(tmp_path), log_name, 'Info'))
+    assert any(name.endswith('.gz' if compression == 'gzip' else '.zst') for name in backups)
+    entries = list(query(str(tmp_path), log_name, levels=['INFO'], rotation_naming='sequence'))
+    assert [entry.record.rsplit(' ', 1)[1] for entry in entries] == [str(i) for i in range(500)]
+
+
+def test_flight_recorder_keeps_records_of_child_loggers(tmp_path, log_name):
+    log = init_logging(log_name, log_directory=str(tmp_path), console_log=False, log_level='INFO',
+                       flight_recorder=10)
+    assert log.getEffectiveLevel() == logging.INFO
+    child = logging.getLogger(log_name + '.child')
+    child.setLevel(logging.DEBUG)
+    child.debug('child context')
+    log.info('info')
+    for handler in log.handlers:
+        handler.flush()
+    # Kept in memory only, until an error
+    assert read_level_file(tmp_path, log_name, 'Debug', '.debug').count('child context') == 0
+    child.error('child failure')
+    for handler in log.handlers:
+        handler.flush()
+    assert read_level_file(tmp_path, log_name, 'Debug', '.debug').count('child context') == 1
+    assert read_level_file(tmp_path, log_name, 'Error', '.error').count('child failure') == 1